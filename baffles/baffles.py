@@ -7,7 +7,6 @@ BAFFLES: Bayesian Ages for Field LowEr-mass Stars
 """
 
 import baffles.ca_constants as const
-from scipy import interpolate
 from scipy.stats import norm,lognorm
 from matplotlib.backends.backend_pdf import PdfPages
 import matplotlib.pyplot as plt
@@ -20,6 +19,26 @@ import sys
 import copy
 import baffles.utils as utils
 import time
+import pickle
+from os.path import join,basename,exists
+import os
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+from baffles.paths import GRIDDIR
+
+MEMORY_BUDGET = 2**28 #default bytes the temporary arrays of a likelihood may take
+TEMP_COPIES = 10 #float64 temporaries the size of the largest array, mostly from the fits
+TABLE_VERSION = 4 #bump when the layout or contents of the precomputed tables change
+LOG_ZERO = -1e30 #stands in for log(0) in the tables so interpolation stays finite
+BV_TOLERANCE_START = 4 #B-V points of every star before doubling them with bv_tolerance
+MAX_BV_POINTS = 1024 #most B-V points of a star
+LI_GRID_GROWTH = 2 #most nodes a Li EW grid shared by a chunk of stars has over their own
+ZOOM_MIN_NODES = 50 #a product whose mass spans fewer ages than this is redone on a zoomed grid
+ZOOM_POINTS = 400 #ages of the zoomed grid
+ZOOM_TAIL = 1e-7 #probability left out on each side of the zoomed grid
+ZOOM_LOG_DROP = 20 #the log product at the ends of the zoomed grid must be this far below its peak
+LIKELIHOOD_CACHE_DECIMALS = 6 #decimal places of the star inputs kept in likelihood_cache keys
 
 # shortcut to quickly computing using default grids the posteriors for calcium and/or lithium
 def baffles_age(bv=None,rhk=None,li=None,bv_err=None,li_err = None,upperLim=False,
@@ -59,12 +78,10 @@ def baffles_age(bv=None,rhk=None,li=None,bv_err=None,li_err = None,upperLim=Fals
     p3 = None
     if (p and p2):
         title = 'Final Posterior'
-        y = p.array * p2.array
-        prob.normalize(const.AGE,y)
-        stats = prob.stats(const.AGE,y)
-        my_plot.posterior(const.AGE,y,prob.stats(const.AGE,y),title,pdfPage,showPlots)
-        p3 = posterior()
-        p3.array,p3.stats = y,stats
+        p3 = posterior(prob.log_normalize(const.AGE,p.log_array + p2.log_array))
+        y = p3.array
+        stats = p3.stats = prob.stats(const.AGE,p3.log_array,log=True)
+        my_plot.posterior(const.AGE,y,stats,title,pdfPage,showPlots)
         print("Final Median Age: %.3g Myr, 68%% CI: %.3g - %.3g, 95%% CI: %.3g - %.3g" \
                % (stats[2],stats[1],stats[3],stats[0],stats[4]))
 
@@ -78,36 +95,435 @@ def baffles_age(bv=None,rhk=None,li=None,bv_err=None,li_err = None,upperLim=Fals
     return p if p is not None else p2
 
 
+#The posterior is kept as log_array, the log of the normalized posterior, and array is
+# made from it the first time it is used. Setting either one replaces the other
 class posterior:
-    def __init__(self):
+    def __init__(self,log_array=None,age=const.AGE):
         self.stats = None  #holds age at different CDF values
-        self.array = None  # posterior array
+        self.age = age  # ages the posterior is given at
+        self.log_array = log_array  # log of the posterior array
         self.upperLim = False  # if its an upper-limit
-        self.stars_posteriors = None #array of individual stellar posteriors if array is a product
+        self.stars_posteriors = None #posterior_batch of the stellar posteriors if array is a product
+        self.zoomed = None #product on a zoomed age grid, see posterior_product
+
+    @property
+    def log_array(self):
+        return self._log_array
+
+    @log_array.setter
+    def log_array(self,log_array):
+        self._log_array = log_array
+        self._array = None
+
+    # posterior array
+    @property
+    def array(self):
+        if self._array is None and self._log_array is not None:
+            self._array = np.exp(self._log_array)
+        return self._array
+
+    @array.setter
+    def array(self,array):
+        with np.errstate(divide='ignore'):
+            self._log_array = None if array is None else np.log(array)
+        self._array = array
+
+    # [lower,upper] highest density interval holding mass, or one per mass if it is a list
+    def hdi(self,mass=0.68):
+        return prob.hdi_batch(self.age,self.log_array,mass,log=True)[0]
+
+    # [lower,upper] equal-tailed credible interval at level, or one per level
+    def credible_interval(self,level=0.68):
+        return prob.credible_batch(self.age,self.log_array,level,log=True)[0]
+
+
+#Posteriors of many stars held as one 2D array, log_array, with a row per star over the
+# ages of age and an upperLim flag per row. array, stats, mode, percentiles and hdi are
+# computed for all rows at once the first time they are asked for and then cached.
+# Indexing with an integer gives that star's posterior; a slice gives a batch sharing the
+# same memory (index arrays copy, like numpy) with the cached values sliced along.
+# Iterating yields each row as a new linear posterior array
+class posterior_batch:
+    __slots__ = ['age','log_array','upperLim','cache']
+
+    def __init__(self,age,log_array,upperLim=False):
+        self.age = np.asarray(age)
+        self.log_array = np.atleast_2d(log_array)
+        self.upperLim = np.broadcast_to(np.asarray(upperLim,dtype=bool),len(self.log_array))
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.log_array)
+
+    def __iter__(self):
+        for row in self.log_array:
+            yield np.exp(row)
+
+    def __getitem__(self,key):
+        if isinstance(key,(int,np.integer)):
+            p = posterior(self.log_array[key],self.age)
+            p.upperLim = bool(self.upperLim[key])
+            stats = self.cache.get('stats')
+            p.stats = stats[key][:4 if p.upperLim else 5] if stats is not None else \
+                      prob.stats(self.age,p.log_array,p.upperLim,log=True)
+            return p
+        batch = posterior_batch(self.age,self.log_array[key],self.upperLim[key])
+        batch.cache = {k:v[key] for k,v in self.cache.items()}
+        return batch
+
+    def cached(self,key,compute):
+        if key not in self.cache:
+            self.cache[key] = compute()
+        return self.cache[key]
+
+    # posterior arrays
+    @property
+    def array(self):
+        return self.cached('array',lambda: np.exp(self.log_array))
+
+    # prob.stats of each row, padded with nan for upper-limits
+    @property
+    def stats(self):
+        return self.cached('stats',lambda: prob.stats_batch(self.age,self.log_array,
+                                                            upperLim=self.upperLim,log=True))
+
+    # age of the peak of each row
+    @property
+    def mode(self):
+        return self.cached('mode',lambda: self.age[np.argmax(self.log_array,axis=1)])
+
+    # ages at the cdf values probs for each row
+    def percentiles(self,probs):
+        probs = tuple(np.atleast_1d(probs).tolist())
+        return self.cached(('percentiles',probs),lambda: prob.stats_batch(self.age,
+                                                    self.log_array,probs,log=True))
+
+    # [lower,upper] of the highest density interval of each row holding mass, with an
+    # extra axis if mass is a list of them. See prob.hdi_batch
+    def hdi(self,mass=0.68):
+        key = ('hdi',tuple(mass) if np.ndim(mass) else mass)
+        return self.cached(key,lambda: prob.hdi_batch(self.age,self.log_array,mass,log=True))
+
+    # [lower,upper] of the equal-tailed credible interval of each row at level, with an
+    # extra axis if level is a list of them
+    def credible_intervals(self,level=0.68):
+        key = ('credible',tuple(level) if np.ndim(level) else level)
+        return self.cached(key,lambda: prob.credible_batch(self.age,self.log_array,level,
+                                                           log=True))
+
+    # saves the log posteriors to fileName.npy, and the ages and upperLim flags to a pickle
+    # beside it, fileName.p, so the ages keep float64 whatever the dtype of the posteriors
+    def save(self,fileName):
+        if fileName[-4:] == '.npy':
+            fileName = fileName[:-4]
+        np.save(fileName,self.log_array)
+        info = {'age':np.asarray(self.age,dtype=np.float64),'upperLim':np.array(self.upperLim)}
+        pickle.dump(info,open(fileName + '.p','wb+'))
+
+#loads a posterior_batch saved with posterior_batch.save. With mmap_mode='r' the posteriors
+# stay on disk and are read as they are used
+def load_posterior_batch(fileName,mmap_mode=None):
+    if fileName[-4:] == '.npy':
+        fileName = fileName[:-4]
+    info = pickle.load(open(fileName + '.p','rb'))
+    return posterior_batch(info['age'],np.load(fileName + '.npy',mmap_mode=mmap_mode),
+                           info['upperLim'])
+
+
+#Running posterior product of a cluster whose members change. Each star's log posterior
+# from estimator.log_posteriors is computed once when the star is added and kept under the
+# key add_star returns, so adding or removing a member costs one star's likelihood and an
+# update of the sum instead of redoing the whole product. The finite part of the sum and the
+# number of stars ruling out each age are kept apart so removing a star that ruled out an
+# age brings it back exactly. log_array, array and stats are of the current members and are
+# cached until the next change. Repeated adds and removes leave rounding in the sum of
+# order 1e-16 of the largest log posterior, refresh sums the kept rows again
+class cluster_posterior:
+    def __init__(self,estimator,dtype=None):
+        self.estimator = estimator
+        self.dtype = np.dtype(dtype) if dtype else estimator.dtype
+        self.rows = {} #key -> log posterior of the star
+        self.stars = {} #key -> (bv,metallicity,bv_err,measure_err,upperLim,maxAge)
+        self.next_key = 0
+        self.log_sum = np.zeros(len(estimator.age)) #sum of the finite log posteriors
+        self.ruled_out = np.zeros(len(estimator.age),dtype=int) #stars with -inf at each age
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self,key):
+        return key in self.rows
+
+    #adds a star, with the arguments of get_posterior, and returns its key. Like
+    # posterior_product, Li EW may be given as log10(EW), as readData returns it
+    def add_star(self,bv,metallicity,bv_err=None,measure_err=None,upperLim=False,maxAge=None):
+        return self.add_stars([bv],[metallicity],[bv_err],[measure_err],[upperLim],[maxAge])[0]
+
+    #adds many stars with one call to log_posteriors and returns their keys
+    def add_stars(self,bv_arr,metallicity_arr,bv_errs=None,measure_err_arr=None,
+                  upperLim_arr=None,maxAge_arr=None):
+        num = len(metallicity_arr)
+        fill = lambda arr,x: list(arr) if arr is not None else [x]*num
+        c = self.estimator.const
+        if self.estimator.metal == 'lithium' and np.mean(metallicity_arr) < 3:
+            metallicity_arr = np.power(10,metallicity_arr)
+        bv_arr = [0.65 if bv is None else bv for bv in fill(bv_arr,None)]
+        args = (bv_arr,list(metallicity_arr),
+                [e if e else c.BV_UNCERTAINTY for e in fill(bv_errs,None)],
+                [e if e else c.MEASURE_ERR for e in fill(measure_err_arr,None)],
+                [bool(u) for u in fill(upperLim_arr,False)],fill(maxAge_arr,None))
+        log_post = self.estimator.log_posteriors(*args,dtype=self.dtype)
+        keys = list(range(self.next_key,self.next_key + num))
+        self.next_key += num
+        for k,key in enumerate(keys):
+            self.rows[key] = log_post[k]
+            self.stars[key] = tuple(a[k] for a in args)
+        self.update(log_post,1)
+        return keys
+
+    #removes the star with key and returns its log posterior
+    def remove_star(self,key):
+        if key not in self.rows:
+            raise RuntimeError("No star with key %s in the cluster" % str(key))
+        row = self.rows.pop(key)
+        del self.stars[key]
+        self.update(row.reshape(1,-1),-1)
+        return row
+
+    #adds (sign=1) or subtracts (sign=-1) the rows of log_post from the running sum
+    def update(self,log_post,sign):
+        finite = np.isfinite(log_post)
+        self.log_sum += sign*np.sum(np.where(finite,log_post,0),axis=0,dtype=np.float64)
+        self.ruled_out += sign*np.sum(~finite,axis=0)
+        self.cache = {}
+
+    #sums the kept log posteriors of the members again, clearing the rounding of the updates
+    def refresh(self):
+        self.log_sum[:] = 0
+        self.ruled_out[:] = 0
+        if self.rows:
+            self.update(np.array(list(self.rows.values())),1)
+
+    #star arrays of the members in the order of log_posteriors, with their keys
+    def members(self):
+        keys = list(self.stars)
+        return keys,tuple(list(a) for a in zip(*[self.stars[k] for k in keys]))
+
+    def cached(self,key,compute):
+        if key not in self.cache:
+            self.cache[key] = compute()
+        return self.cache[key]
+
+    #log of the unnormalized product, 0 everywhere with no members or if the members
+    # rule out every age
+    def ln_prob(self):
+        ln_prob = np.where(self.ruled_out > 0,-np.inf,self.log_sum)
+        if np.all(ln_prob == -np.inf):
+            ln_prob[:] = 0
+        return ln_prob
+
+    # log of the normalized posterior product of the members
+    @property
+    def log_array(self):
+        return self.cached('log_array',lambda: prob.log_normalize(self.estimator.age,
+                                                                  self.ln_prob()))
+
+    @property
+    def array(self):
+        return self.cached('array',lambda: np.exp(self.log_array))
+
+    # prob.stats of the product on the estimator's ages
+    @property
+    def stats(self):
+        return self.cached('stats',lambda: prob.stats(self.estimator.age,self.ln_prob(),
+                                                      log=True))
+
+    #the product as a posterior, like posterior_product. With zoom a narrow product is
+    # redone on a zoomed grid, which needs the likelihoods of all members again
+    def posterior(self,zoom=False,showStars=False):
+        est = self.estimator
+        p = posterior(self.log_array,est.age)
+        p.stats = self.stats
+        if showStars and self.rows:
+            keys,args = self.members()
+            p.stars_posteriors = posterior_batch(est.age,np.array([self.rows[k] for k in keys]),
+                                                 args[4])
+        if zoom and self.rows:
+            p.zoomed = est.zoom_product(self.ln_prob(),self.members()[1],self.dtype)
+            if p.zoomed is not None:
+                p.stats = p.zoomed.stats
+        return p
+
+
+#the work of one chunk of stars in age_estimator.log_product, at module level so worker
+# processes can run it. args are the star arrays of log_posteriors
+def star_log_sum(est,args,dtype,likelihood,keep):
+    if likelihood:
+        ln = est.likelihoods(args[0],args[2],args[1],args[3],args[4],dtype)
+        with np.errstate(divide='ignore'):
+            np.log(ln,out=ln)
+        ln += est.log_priors(args[5],len(ln),ln.dtype)
+    else:
+        ln = est.log_posteriors(*args,dtype)
+    return np.sum(ln,axis=0,dtype=np.float64),(ln if keep else None)
+
+
+#Least recently used store of star likelihoods for age_estimator.likelihoods, holding at
+# most size rows. A star is keyed by its inputs rounded to decimals places along with a
+# prefix naming the grids, fit and settings they were computed with, so rows are only reused
+# where they would come out the same. hits and misses count the stars looked up
+class likelihood_cache:
+    def __init__(self,size,decimals=LIKELIHOOD_CACHE_DECIMALS):
+        self.size = int(size)
+        self.decimals = decimals
+        self.rows = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    #keys of the stars whose inputs are the columns of arrays
+    def keys(self,prefix,*arrays):
+        q = np.round(np.column_stack(arrays).astype(float),self.decimals) + 0.0 #no -0.0
+        return [(prefix,) + tuple(row) for row in q.tolist()]
+
+    #row stored under key, None if there is none. A row found becomes the most recently used
+    def get(self,key):
+        row = self.rows.get(key)
+        if row is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.rows.move_to_end(key)
+        return row
+
+    #stores row under key, dropping the least recently used rows past size
+    def put(self,key,row):
+        self.rows[key] = row
+        self.rows.move_to_end(key)
+        while len(self.rows) > self.size:
+            self.rows.popitem(last=False)
+
+    def clear(self):
+        self.rows.clear()
+        self.hits = self.misses = 0
 
 
 class age_estimator:
     #takes in a metal idicator either 'calcium' or 'lithium' denoting which method to use
     # option to input the grid_median as an array or as string referencing saved .npy files
-    def __init__(self,metal,grid_median=None,default_grids=True,load_pdf_fit=True):
+    # engine selects how the lithium likelihood integral is done: 'kernel' (default) reduces
+    # it to a 1D kernel per star and 'exact' integrates the full (BV,AGE,Li) array
+    # memory_budget is roughly the peak bytes the temporary arrays of the lithium likelihood
+    # may take. Stars and B-V points are processed in chunks to stay within it
+    # quadrature is the rule of prob.standard_normal_quadrature used to integrate over the B-V
+    # uncertainty, with num_bv_points (NUM_BV_POINTS by default) points up to a B-V
+    # uncertainty of 0.03, and proportionally more beyond. Fewer points trade accuracy for speed.
+    # 'hermite' is capped at prob.HERMITE_MAX_POINTS and only suits small B-V uncertainties:
+    # the median grid is piecewise linear and clamped at the ends of BV_RANGE, and over a
+    # wide uncertainty the equal area rule is the more accurate
+    # bv_tolerance instead picks the points of each star: they are doubled from
+    # BV_TOLERANCE_START until doubling again moves its posterior by less than bv_tolerance
+    # in L1, up to MAX_BV_POINTS, and the likelihood with the most points is kept
+    # dtype (np.float64 or np.float32) is the default precision of the batch likelihoods and
+    # posteriors. float32 halves their memory traffic; the exact engine still integrates in
+    # float64. On the bundled lithium clusters float32 star posteriors differ from float64 by
+    # at most 3e-6 in L1 and cluster products by 2e-5, with stats within 5e-6 relative
+    # li_tolerance (LI_TOLERANCE by default) is the relative error allowed in the integral
+    # over Li EW, which sets the number of integration nodes of each star, see li_windows
+    # age is the grid of ages (Myr) the posteriors are given on: an int for that many points
+    # spaced like AGE from 1 Myr to GALAXY_AGE, or an array. AGE by default. Median grids are
+    # stored on AGE and resampled onto it when set, and the posterior and stats tables are
+    # only used on the default grid. The cost of likelihoods and stats scales with its length
+    # cache_size above 0 keeps the lithium likelihoods of up to that many stars in a
+    # likelihood_cache, so stars seen before are not computed again, see cached_likelihoods
+    def __init__(self,metal,grid_median=None,default_grids=True,load_pdf_fit=True,
+                 engine='kernel',memory_budget=MEMORY_BUDGET,quadrature='equal_area',
+                 num_bv_points=None,dtype=np.float64,li_tolerance=None,age=None,cache_size=0,
+                 bv_tolerance=None):
+        if engine not in ['kernel','exact']:
+            raise RuntimeError("Unknown engine '%s'. Please enter kernel or exact" \
+                               % engine)
         self.metal = metal
+        self.engine = engine
+        self.max_elements = max(1,int(memory_budget)//(8*TEMP_COPIES)) #largest array
+        if quadrature not in prob.QUADRATURES:
+            raise RuntimeError("Unknown quadrature '%s'. Please enter one of %s" % \
+                               (quadrature,prob.QUADRATURES))
+        self.quadrature = quadrature
+        if np.dtype(dtype) not in [np.float32,np.float64]:
+            raise RuntimeError("Unsupported dtype %s. Please enter np.float32 or np.float64" \
+                               % np.dtype(dtype))
+        self.dtype = np.dtype(dtype)
         self.grid_median = None
+        self.grid_file = None
+        self.median_interp = None
+        self.posterior_table = None
+        self.stats_table = None
+        self.cdf_lookup = None
+        self.buffers = {} #scratch arrays of the likelihood loops, see buffer
+        self.likelihood_cache = likelihood_cache(cache_size) if cache_size else None
+        self.grid_hash = None #see likelihood_fingerprint
         self.const = utils.init_constants(metal)
-        if (grid_median):
+        if age is None:
+            age = self.const.AGE
+        elif np.ndim(age) == 0:
+            age = np.logspace(np.log10(self.const.AGE[0]),np.log10(self.const.GALAXY_AGE),
+                              int(age))
+        self.age = np.asarray(age,dtype=float)
+        if self.age.ndim != 1 or len(self.age) < 2 or np.any(np.diff(self.age) <= 0):
+            raise RuntimeError("Age grid must be at least 2 increasing ages")
+        self.num_bv_points = num_bv_points if num_bv_points else \
+                             getattr(self.const,'NUM_BV_POINTS',None) #lithium only
+        self.li_tolerance = li_tolerance if li_tolerance else \
+                            getattr(self.const,'LI_TOLERANCE',None)
+        self.bv_tolerance = bv_tolerance
+        self.pdf_width = None
+        if grid_median is not None:
             self.set_grids(grid_median)
         elif (default_grids):
             self.set_grids(self.const.DEFAULT_MEDIAN_GRID)
         if load_pdf_fit: #allows refresh.py to make without needing these
             self.pdf_fit,self.cdf_fit = my_fits.fit_histogram(metal,fromFile=True)
+            self.grid_hash = None
             #self.pdf_fit,self.cdf_fit = my_fits.fit_student_t(metal,fromFile=True)
+            if self.metal == 'calcium':
+                self.load_posterior_table()
+            else:
+                #standard deviation of pdf_fit, the scale it varies on
+                x,pdf = self.pdf_fit.x,self.pdf_fit.y
+                mean = np.trapz(pdf*x,x)/np.trapz(pdf,x)
+                self.pdf_width = np.sqrt(np.trapz(pdf*(x - mean)**2,x)/np.trapz(pdf,x))
+                self.load_stats_table()
+                #upper limits only need cdf_fit, looked up on a uniform grid of residuals
+                self.cdf_lookup = my_fits.uniform_interp(self.cdf_fit,self.cdf_fit.x[0],
+                                    self.cdf_fit.x[-1],self.const.CDF_LOOKUP_STEP)
 
+    #grid_median is a .npy file or an array sampled on BV_S and AGE of the constants. On
+    # another age grid it is resampled linearly in log age
     def set_grids(self,grid_median):
         if (type(grid_median) == str and type(grid_median) == str):
             if (grid_median[-4:] != '.npy'):
                 grid_median += '.npy'
             self.grid_median = np.load(grid_median)
-        elif (type(grid_median) == 'numpy.ndarray'):
+            self.grid_file = grid_median
+        elif isinstance(grid_median,np.ndarray):
             self.grid_median = grid_median
+            self.grid_file = None
+        if not self.default_age():
+            log_age = np.log10(self.const.AGE)
+            self.grid_median = np.array([my_fits.piecewise(log_age,row)(np.log10(self.age))
+                                         for row in np.atleast_2d(self.grid_median)])
+        self.posterior_table = None #only valid for the grid it was built from
+        self.stats_table = None
+        self.median_interp = my_fits.grid_interp(self.const.BV_S,self.age,self.grid_median)
+        self.grid_hash = None
+
+    #whether the posteriors are on the AGE grid of the constants, which the tables are made on
+    def default_age(self):
+        return np.array_equal(self.age,self.const.AGE)
 
     #Takes in bv the (B-V)o corrected color and the metallicity to return a posterior object.
     #Metallicity: log(R'HK) if refering to calcium. log equivalent width per mA if lithium.
@@ -130,63 +546,176 @@ class age_estimator:
                 self.const.METAL_RANGE[1]:
             mamajekAge = utils.getMamaAge(metallicity)
 
-        posterior_arr = self.likelihood(bv,bv_uncertainty,metallicity,measure_err,\
-                upperLim) * self.prior(maxAge)
-        if all(posterior_arr == 0):
+        stats = None
+        if self.posterior_table is not None:
+            log_post,stats = self.table_posterior(metallicity,maxAge,log=True)
+        else:
+            with np.errstate(divide='ignore'):
+                log_post = np.log(self.likelihood(bv,bv_uncertainty,metallicity,measure_err,\
+                        upperLim)) + self.log_prior(maxAge)
+        if np.all(log_post == -np.inf):
             print("Posterior not well defined. Area is zero so adding constant")
-            posterior_arr += 1
-
-        prob.normalize(self.const.AGE,posterior_arr)
+            log_post[:] = 0
 
-        p_struct = posterior()
-        p_struct.array = posterior_arr
-        p_struct.stats = prob.stats(self.const.AGE,posterior_arr,upperLim)
+        p_struct = posterior(prob.log_normalize(self.age,log_post),self.age)
+        p_struct.stats = stats if stats is not None else \
+                prob.stats(self.age,log_post,upperLim,log=True)
         p_struct.upperLim = upperLim
         if (showPlot or pdfPage):
             if (title == None):
                 title = '(B-V)o = '+'%.2f' % bv \
                         +', ' + self.metal + ' = %.2f' % metallicity
-            my_plot.posterior(self.const.AGE, p_struct.array, p_struct.stats,title,pdfPage,\
+            my_plot.posterior(self.age, p_struct.array, p_struct.stats,title,pdfPage,\
                     showPlot,givenAge=givenAge,givenErr=givenErr, mamajekAge=mamajekAge,logPlot=logPlot)
         return p_struct
 
+    #Vectorized get_posterior for many stars at once. Returns an N x len(AGE) matrix
+    # with one normalized posterior per row. Metallicity is linear Li EW in mA for lithium
+    # dtype overrides the estimator's dtype for this call
+    def get_posteriors(self,bv_arr,metallicity_arr,bv_errs=None,measure_err_arr=None,\
+            upperLim_arr=None,maxAge_arr=None,dtype=None):
+        log_post = self.log_posteriors(bv_arr,metallicity_arr,bv_errs,measure_err_arr,
+                                       upperLim_arr,maxAge_arr,dtype)
+        return np.exp(log_post,out=log_post)
+
+    #Same as get_posteriors but returns a posterior_batch
+    def get_posterior_batch(self,bv_arr,metallicity_arr,bv_errs=None,measure_err_arr=None,\
+            upperLim_arr=None,maxAge_arr=None,dtype=None):
+        log_post = self.log_posteriors(bv_arr,metallicity_arr,bv_errs,measure_err_arr,
+                                       upperLim_arr,maxAge_arr,dtype)
+        return posterior_batch(self.age,log_post,
+                               upperLim_arr if upperLim_arr is not None else False)
+
+    #Same as get_posteriors but returns the logs of the posteriors, normalized with
+    # prob.log_normalize. Ages ruled out by a likelihood or prior are -inf
+    def log_posteriors(self,bv_arr,metallicity_arr,bv_errs=None,measure_err_arr=None,\
+            upperLim_arr=None,maxAge_arr=None,dtype=None):
+        dtype = np.dtype(dtype) if dtype else self.dtype
+        metallicity_arr = np.atleast_1d(np.asarray(metallicity_arr,dtype=float))
+        if bv_arr is None and self.metal=='calcium': bv_arr = [0.65]*len(metallicity_arr)
+        bv_arr = np.atleast_1d(np.asarray(bv_arr,dtype=float))
+        assert np.all((self.const.BV_RANGE[0] <= bv_arr) & (bv_arr <= self.const.BV_RANGE[1])), \
+                "B-V out of range. Valid range: " + str(self.const.BV_RANGE)
+        metal_range = self.const.METAL_RANGE if self.metal=='calcium' else \
+                self.const.METAL_RANGE_LIN
+        assert np.all((metal_range[0] <= metallicity_arr) & \
+                (metallicity_arr <= metal_range[1])), \
+                "Indicator value out of range. Valid range: " + str(metal_range)
+
+        if self.posterior_table is not None:
+            log_post = self.table_posterior(metallicity_arr,log=True)[0].astype(dtype)
+        else:
+            log_post = self.likelihoods(bv_arr,bv_errs,metallicity_arr,measure_err_arr,\
+                    upperLim_arr,dtype)
+            with np.errstate(divide='ignore'):
+                np.log(log_post,out=log_post)
+        if maxAge_arr is not None:
+            log_post += self.log_priors(maxAge_arr,len(bv_arr),dtype)
+        undefined = np.all(log_post == -np.inf,axis=1)
+        if np.any(undefined):
+            print("%d posteriors not well defined. Area is zero so adding constant" \
+                  % np.sum(undefined))
+            log_post[undefined] = 0
+
+        return prob.log_normalize(self.age,log_post)
+
+    #product of numIter posterior products of sample_num stars drawn from the stars, without
+    # replacement unless replace. The star posteriors are computed once and each draw is a
+    # sum of their rows, see resampled_products. seed is a seed or np.random.Generator
+    # showStars keeps the star posteriors as stars_posteriors and plots them
     def resample_posterior_product(self,bv_arr,metallicity_arr,bv_errs=None,measure_err_arr=None,\
             upperLim_arr=None,maxAge_arr = None, \
             pdfPage=None,showPlot=False,showStars=False,title=None,givenAge=None,givenErr = None,
-            sample_num=None,numIter=4):
-        if (bv_errs is None):
-            bv_errs = [self.const.BV_UNCERTAINTY]*len(bv_arr)
-        if upperLim_arr is None:
-            upperLim_arr = [False]*len(metallicity_arr)
-        if maxAge_arr is None:
-            maxAge_arr = [None]*len(metallicity_arr)
-        if measure_err_arr is None:
-            measure_err_arr = [self.const.MEASURE_ERR]*len(metallicity_arr)
+            sample_num=None,numIter=4,replace=False,seed=None):
         if sample_num is None: sample_num = 15#len(bv_arr) - 5
 
-        ln_prob = np.zeros(len(self.const.AGE))
-        star_post = []
-
-        resample_args = (bv_arr,metallicity_arr,bv_errs,measure_err_arr,upperLim_arr,maxAge_arr)
-        args = (pdfPage,showPlot,showStars,title,givenAge,givenErr)
+        if self.metal == 'lithium' and np.mean(metallicity_arr) < 3:
+            metallicity_arr = np.power(10,metallicity_arr)
 
-        post = prob.resample(self.posterior_product,resample_args,args,sample_num,numIter)
+        log_post = self.log_posteriors(bv_arr,metallicity_arr,bv_errs,measure_err_arr,
+                                       upperLim_arr,maxAge_arr)
+        star_post = posterior_batch(self.age,log_post,upperLim_arr if upperLim_arr is not None \
+                                    else False) if showStars else None
+        log_post = np.sum(self.resampled_products(log_post,sample_num,numIter,replace,seed),
+                          axis=0)
 
-        prob.normalize(self.const.AGE,post)
-        p_struct = posterior()
-        p_struct.array = post
-        p_struct.stats = prob.stats(self.const.AGE,post)
+        p_struct = posterior(prob.log_normalize(self.age,log_post),self.age)
+        p_struct.stats = prob.stats(self.age,log_post,log=True)
+        p_struct.stars_posteriors = star_post
 
         if (showPlot or pdfPage):
             title = title if title else 'Resampled Posterior Product Age Distribution'
-            my_plot.posterior(self.const.AGE, p_struct.array, p_struct.stats,title,\
-                    pdfPage,showPlot,star_post,givenAge,givenErr=givenErr)
+            my_plot.posterior(self.age, p_struct.array, p_struct.stats,title,\
+                    pdfPage,showPlot,star_post if showStars else [],givenAge,givenErr=givenErr)
 
         return p_struct
 
+    #Bootstrap of the posterior product: numIter products of as many stars as given, drawn
+    # with replacement, from the star posteriors computed once. Returns a posterior_batch of
+    # the replicate products, whose stats give bootstrap intervals on the age, e.g.
+    # np.percentile(batch.stats[:,2],[16,84]) for the spread of the median. The products
+    # are on the estimator's ages without zooming
+    def bootstrap_posterior_product(self,bv_arr,metallicity_arr,bv_errs=None,
+            measure_err_arr=None,upperLim_arr=None,maxAge_arr=None,numIter=1000,seed=None,
+            dtype=None):
+        if self.metal == 'lithium' and np.mean(metallicity_arr) < 3:
+            metallicity_arr = np.power(10,metallicity_arr)
+        log_post = self.log_posteriors(bv_arr,metallicity_arr,bv_errs,measure_err_arr,
+                                       upperLim_arr,maxAge_arr,dtype)
+        return posterior_batch(self.age,self.resampled_products(log_post,len(log_post),
+                                                                numIter,True,seed))
+
+    #Leave-one-out jackknife of the posterior product. The star log posteriors are computed
+    # once and each star's row is taken out of their sum, so it costs about one product.
+    # Returns a posterior_batch whose row i is the product without star i, and the influence
+    # of each star: how far leaving it out moves the median of the product, in units of half
+    # the 68% interval of the product of all stars. The products are on the estimator's ages
+    def jackknife_posterior_product(self,bv_arr,metallicity_arr,bv_errs=None,
+            measure_err_arr=None,upperLim_arr=None,maxAge_arr=None,dtype=None):
+        if self.metal == 'lithium' and np.mean(metallicity_arr) < 3:
+            metallicity_arr = np.power(10,metallicity_arr)
+        log_post = self.log_posteriors(bv_arr,metallicity_arr,bv_errs,measure_err_arr,
+                                       upperLim_arr,maxAge_arr,dtype)
+        #-inf entries are counted apart from the sum so taking a star out can restore an age
+        finite = np.isfinite(log_post)
+        log_sum = np.sum(np.where(finite,log_post,0),axis=0,dtype=np.float64)
+        ruled_out = np.sum(~finite,axis=0)
+
+        ln_prob = np.subtract(log_sum,log_post,where=finite,out=np.tile(log_sum,
+                                                                        (len(log_post),1)))
+        ln_prob[ruled_out - ~finite > 0] = -np.inf
+        ln_prob[np.all(ln_prob == -np.inf,axis=1)] = 0
+        batch = posterior_batch(self.age,prob.log_normalize(self.age,ln_prob))
+
+        full = np.where(ruled_out > 0,-np.inf,log_sum)
+        if np.all(full == -np.inf):
+            full[:] = 0
+        stats = prob.stats(self.age,full,log=True)
+        influence = (batch.stats[:,2] - stats[2])/((stats[3] - stats[1])/2)
+        return batch,influence
+
+    #normalized log posterior products of numIter draws of sample_num rows of log_post, the
+    # N x len(age) log star posteriors, as a numIter x len(age) matrix. Draws that rule out
+    # every age are flat, like in posterior_product
+    def resampled_products(self,log_post,sample_num,numIter,replace=False,seed=None):
+        inds = prob.resample_indices(len(log_post),sample_num,numIter,replace,seed)
+        ln_prob = prob.resample_log_sums(log_post,inds)
+        ln_prob[np.all(ln_prob == -np.inf,axis=1)] = 0
+        return prob.log_normalize(self.age,ln_prob)
+
+    #dtype overrides the estimator's dtype for the star posteriors. Their logs are summed in
+    # float64 either way so the product stays stable over many stars
+    # n_jobs and executor split the stars across worker processes, see log_product. Without an
+    # executor one pool is made for the product and its zoom stage
+    # With zoom, a product whose mass falls on fewer than ZOOM_MIN_NODES ages is computed again
+    # from the star likelihoods on ZOOM_POINTS ages spaced like AGE over just that mass, and
+    # its stats come from there. The posterior array stays on the estimator's ages, and
+    # the product on the zoomed ages is kept as the posterior's zoomed
     def posterior_product(self,bv_arr,metallicity_arr,bv_errs=None,measure_err_arr=None,\
             upperLim_arr=None,maxAge_arr = None, \
-            pdfPage=None,showPlot=False,showStars=False,title=None,givenAge=None,givenErr = None):
+            pdfPage=None,showPlot=False,showStars=False,title=None,givenAge=None,givenErr = None,
+            dtype=None,zoom=True,n_jobs=1,executor=None):
+        dtype = np.dtype(dtype) if dtype else self.dtype
         if (bv_errs is None):
             bv_errs = [self.const.BV_UNCERTAINTY]*len(bv_arr)
         if upperLim_arr is None:
@@ -195,53 +724,175 @@ class age_estimator:
             maxAge_arr = [None]*len(metallicity_arr)
         if measure_err_arr is None:
             measure_err_arr = [self.const.MEASURE_ERR]*len(metallicity_arr)
-        ln_prob = np.zeros(len(self.const.AGE))
         star_post = []
 
-        np.seterr(divide = 'ignore')
-
         if self.metal == 'lithium' and np.mean(metallicity_arr) < 3:
             metallicity_arr = np.power(10,metallicity_arr)
 
-        sec_per_star = 0.5
         start=time.time()
-        for i in range(len(bv_arr)):
-            star_time=time.time()
-            y = self.likelihood(bv_arr[i],bv_errs[i],metallicity_arr[i],measure_err_arr[i],\
-                  upperLim_arr[i]) * self.prior(maxAge_arr[i])
-            prob.normalize(self.const.AGE,y)
-            inds = np.nonzero(y)[0]
-            ln_prob += np.log(y)
+        args = (bv_arr,metallicity_arr,bv_errs,measure_err_arr,upperLim_arr,maxAge_arr)
+        #the product and its zoom stage share one pool of workers
+        with self.worker_pool(n_jobs,len(bv_arr),executor) as pool:
+            ln_prob,log_post = self.log_product(args,dtype,keep=showStars,n_jobs=n_jobs,
+                                                executor=pool)
             if (showStars):
-                star_post.append(y)
-            utils.progress_bar(float(i+1)/len(bv_arr),int((len(bv_arr)-(i+1))*sec_per_star))
-            #exp moving average
-            sec_per_star = sec_per_star + 0.1*((time.time() - star_time) - sec_per_star)
-            #sec_per_star = (time.time() - start)/float(i+1)
-
-        print("Finished %d stars. Average time per star: %.2f seconds." \
-              % (len(bv_arr),(time.time() - start)/len(bv_arr)))
-
-        post = np.exp(ln_prob - np.max(ln_prob))  #prevent underflow
-        prob.normalize(self.const.AGE,post)
-        p_struct = posterior()
-        p_struct.array = post
-        p_struct.stats = prob.stats(self.const.AGE,post)
-        p_struct.stars_posteriors = star_post
+                star_post = posterior_batch(self.age,log_post,upperLim_arr)
+
+            print("Finished %d stars. Average time per star: %.2f seconds." \
+                  % (len(bv_arr),(time.time() - start)/len(bv_arr)))
+
+            if np.all(ln_prob == -np.inf):
+                print("Posterior product not well defined. The stars rule out every age so " \
+                      "adding constant")
+                ln_prob[:] = 0
+            p_struct = posterior(prob.log_normalize(self.age,ln_prob),self.age)
+            p_struct.stats = prob.stats(self.age,ln_prob,log=True)
+            p_struct.stars_posteriors = star_post
+            p_struct.zoomed = self.zoom_product(ln_prob,args,dtype,n_jobs,pool) if zoom else None
+        if p_struct.zoomed is not None:
+            p_struct.stats = p_struct.zoomed.stats
 
         if (showPlot or pdfPage):
-            my_plot.posterior(self.const.AGE, p_struct.array, p_struct.stats,title,\
+            my_plot.posterior(self.age, p_struct.array, p_struct.stats,title,\
                               pdfPage,showPlot,star_post,givenAge,givenErr=givenErr,\
                               bv_arr = bv_arr,metal=self.metal)
         return p_struct
 
+    #Second stage of posterior_product for a normalized log product ln_prob whose mass is on
+    # fewer than ZOOM_MIN_NODES ages: the star likelihoods are evaluated again on ZOOM_POINTS
+    # ages from a little before the age where its cdf is ZOOM_TAIL to a little after where
+    # it is 1 - ZOOM_TAIL. The range is widened while the product at an end is within
+    # ZOOM_LOG_DROP of its peak. Returns the product there as a posterior, None if the
+    # product is wide enough already
+    def zoom_product(self,ln_prob,args,dtype,n_jobs=1,executor=None):
+        c = np.exp(prob.log_cdf_batch(self.age,ln_prob)[0])
+        a = np.searchsorted(c,ZOOM_TAIL) - 2
+        b = np.searchsorted(c,1 - ZOOM_TAIL) + 2
+        if b - a >= ZOOM_MIN_NODES + 4:
+            return None
+        for _ in range(3):
+            a,b = max(a,0),min(b,len(self.age) - 1)
+            est = self.with_age(np.logspace(np.log10(self.age[a]),np.log10(self.age[b]),
+                                            ZOOM_POINTS))
+            ln = est.log_product(args,dtype,likelihood=True,n_jobs=n_jobs,executor=executor)[0]
+            if np.all(ln == -np.inf):
+                return None
+            low = ln[0] > np.max(ln) - ZOOM_LOG_DROP and a > 0
+            high = ln[-1] > np.max(ln) - ZOOM_LOG_DROP and b < len(self.age) - 1
+            if not (low or high):
+                break
+            width = b - a
+            a,b = a - width*low,b + width*high
+        p = posterior(prob.log_normalize(est.age,ln),est.age)
+        p.stats = prob.stats(est.age,ln,log=True)
+        return p
+
+    #Sum over stars of their log posteriors, or with likelihood=True of their log likelihoods
+    # and log priors, which differ from it by a constant. args are the star arrays of
+    # log_posteriors. Returns the sum in float64 and, if keep, the N x len(age) log
+    # posteriors (or likelihoods). With n_jobs above 1 (-1 for one per cpu) the stars are
+    # split into n_jobs contiguous chunks done in worker processes of executor, or of a
+    # ProcessPoolExecutor made for the call. The partial sums are added in chunk order, so
+    # the result does not depend on which worker finishes first. Scripts using workers need
+    # the usual if __name__ == '__main__' guard
+    def log_product(self,args,dtype,likelihood=False,keep=False,n_jobs=1,executor=None):
+        num = len(args[1])
+        n_jobs = self.job_count(n_jobs,num)
+        if n_jobs <= 1:
+            return star_log_sum(self,args,dtype,likelihood,keep)
+        bounds = np.linspace(0,num,n_jobs + 1).astype(int)
+        with self.worker_pool(n_jobs,num,executor) as pool:
+            futures = [pool.submit(star_log_sum,self,tuple(a[i:j] for a in args),dtype,
+                                   likelihood,keep) for i,j in zip(bounds[:-1],bounds[1:])]
+            parts = [f.result() for f in futures]
+        total = np.zeros(len(self.age))
+        for part,_ in parts:
+            total += part
+        return total,(np.concatenate([ln for _,ln in parts]) if keep else None)
+
+    #number of workers n_jobs asks for num stars, -1 being one per cpu
+    def job_count(self,n_jobs,num):
+        n_jobs = os.cpu_count() if n_jobs is not None and n_jobs < 0 else n_jobs
+        return min(n_jobs or 1,num)
+
+    #context giving the executor to run n_jobs workers on: executor itself if given, None if
+    # one job is enough, otherwise a ProcessPoolExecutor shut down at the end of the context
+    def worker_pool(self,n_jobs,num,executor=None):
+        if executor is not None or self.job_count(n_jobs,num) <= 1:
+            return contextlib.nullcontext(executor)
+        return ProcessPoolExecutor(self.job_count(n_jobs,num))
+
+    #The estimator is pickled for worker processes without its scratch buffers, likelihood
+    # cache and stats table. The constants module and the posterior table are loaded again
+    # from their files on the other side and the interpolators of the median
+    # grid and cdf_fit are made again, instead of being copied
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['buffers'] = {}
+        state['likelihood_cache'] = None
+        state['stats_table'] = None
+        state['posterior_table'] = self.posterior_table is not None
+        state['median_interp'] = None
+        state['cdf_lookup'] = self.cdf_lookup is not None
+        del state['const']
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.const = utils.init_constants(self.metal)
+        if self.grid_median is not None:
+            self.median_interp = my_fits.grid_interp(self.const.BV_S,self.age,self.grid_median)
+        if self.cdf_lookup:
+            self.cdf_lookup = my_fits.uniform_interp(self.cdf_fit,self.cdf_fit.x[0],
+                                    self.cdf_fit.x[-1],self.const.CDF_LOOKUP_STEP)
+        else:
+            self.cdf_lookup = None
+        if self.posterior_table:
+            self.load_posterior_table()
+        else:
+            self.posterior_table = None
+
+    #copy of the estimator giving posteriors on the ages age, sharing its fits and scratch
+    # buffers. The median grid is resampled from the current ages in log age, and the
+    # precomputed tables are dropped
+    def with_age(self,age):
+        est = age_estimator.__new__(age_estimator) #copy.copy would go through __getstate__
+        est.__dict__.update(self.__dict__)
+        est.age = np.asarray(age,dtype=float)
+        log_age = np.log10(self.age)
+        est.grid_median = np.array([my_fits.piecewise(log_age,row)(np.log10(est.age))
+                                    for row in np.atleast_2d(self.grid_median)])
+        est.median_interp = my_fits.grid_interp(self.const.BV_S,est.age,est.grid_median)
+        est.grid_hash = None
+        est.posterior_table = None
+        est.stats_table = None
+        return est
+
     # Prior on age
     def prior(self,maxAge=None):
         agePrior = 1
         if maxAge is not None and maxAge < self.const.GALAXY_AGE:
-            agePrior = self.const.AGE <= maxAge
+            agePrior = self.age <= maxAge
         return agePrior
 
+    # N x len(AGE) matrix of priors, one row per entry of maxAge_arr
+    def priors(self,maxAge_arr=None,num=None,dtype=float):
+        if maxAge_arr is None:
+            maxAge_arr = [None]*num
+        maxAge_arr = np.array([self.const.GALAXY_AGE if m is None else m for m in maxAge_arr],
+                              dtype=float)
+        agePrior = self.age <= maxAge_arr.reshape(-1,1)
+        agePrior[maxAge_arr >= self.const.GALAXY_AGE] = True
+        return agePrior.astype(dtype)
+
+    # log of prior, 0 where an age is allowed and -inf where it is not
+    def log_prior(self,maxAge=None):
+        return np.where(self.prior(maxAge),0.0,-np.inf)
+
+    # log of priors
+    def log_priors(self,maxAge_arr=None,num=None,dtype=float):
+        return np.where(self.priors(maxAge_arr,num,bool),0,-np.inf).astype(dtype)
+
     def calcium_likelihood(self,bv,rhk):
         mu = self.grid_median
         #like gaussian likelihood, divide by std which scales height of function
@@ -253,44 +904,508 @@ class age_estimator:
     # assumes li is linear space
     def likelihood(self,bv,bv_uncertainty,li,measure_err,isUpperLim):
         if self.metal == 'calcium': return self.calcium_likelihood(bv,li)
+        if self.engine != 'exact' or self.bv_tolerance:
+            return self.likelihoods([bv],[bv_uncertainty],[li],[measure_err],[isUpperLim])[0]
         if not bv_uncertainty:
             bv_uncertainty = self.const.BV_UNCERTAINTY
         if not measure_err:
             measure_err = self.const.MEASURE_ERR
 
-        num_points = int(
-            self.const.NUM_BV_POINTS if bv_uncertainty <= 0.03 else
-            self.const.NUM_BV_POINTS * (bv_uncertainty/0.03)
-        )
-
-        # By spacing the points according to area, the weighting for each B-V point is
-        #implicit.  More points are clustered near bv than farther
-        BV = prob.gaussian_cdf_space(bv,bv_uncertainty,num_points, sig_lim=3)
+        # With the default equal area rule the weighting for each B-V point is implicit.
+        # More points are clustered near bv than farther
+        z,w = prob.standard_normal_quadrature(int(self.bv_point_count(bv_uncertainty)),
+                                              self.quadrature)
+        BV = bv + bv_uncertainty*z
 
-        f = interpolate.interp2d(self.const.AGE,self.const.BV_S,self.grid_median)
-        mu = f(self.const.AGE,BV)
+        final_sum = np.zeros(len(self.age))
 
         if isUpperLim:
             #integration done in logspace with log li and log mu
-            astro_gauss = self.cdf_fit(np.log10(li) - mu)
-            final_sum = np.sum(astro_gauss,axis=0)
+            for sl in self.bv_slices(len(BV),len(self.age)):
+                astro_gauss = self.cdf_fit(np.log10(li) - self.median_interp(BV[sl]))
+                final_sum += np.dot(w[sl],astro_gauss)
             return final_sum
 
-        mu = mu.reshape(mu.shape[0],mu.shape[1],1)
+        #the integral over Li and the sum over B-V are one contraction of the pdf_fit values
+        # against the weights of the Li EW nodes and the B-V points
+        u,li_weights = self.li_nodes([li],[measure_err])
 
-        li_gauss = prob.gaussian(self.const.METAL,li,measure_err)
-        mask = li_gauss > prob.FIVE_SIGMAS
-        li_gauss = li_gauss[mask]
-        li_gauss = li_gauss.reshape(1,1,len(li_gauss))
-        METAL = self.const.METAL[mask]
-        METAL = METAL.reshape(1,1,len(METAL))
+        #the B-V points are done in slices so the pdf_fit values stay within max_elements
+        for sl in self.bv_slices(len(BV),len(self.age)*len(u)):
+            mu = self.median_interp(BV[sl])
+            astro_gauss = self.pdf_fit(u - mu.reshape(mu.shape[0],-1,1))
+            final_sum += np.einsum('bak,k,b->a',astro_gauss,li_weights[0],w[sl],optimize=True)
+        return final_sum
+
+    #number of B-V points to integrate over a B-V uncertainty, works on arrays too
+    def bv_point_count(self,bv_uncertainty):
+        count = np.where(np.asarray(bv_uncertainty) <= 0.03,self.num_bv_points,
+                         self.num_bv_points*(np.asarray(bv_uncertainty)/0.03)).astype(int)
+        return np.minimum(count,self.max_bv_points())
+
+    #most B-V points the quadrature rule may use
+    def max_bv_points(self):
+        return prob.HERMITE_MAX_POINTS if self.quadrature == 'hermite' else MAX_BV_POINTS
+
+    #splits the star indices idx into chunks of as many stars as fit in max_elements
+    # when each star takes elements
+    def star_chunks(self,idx,elements):
+        size = max(1,self.max_elements//max(1,elements))
+        return [idx[k:k+size] for k in range(0,len(idx),size)]
+
+    #splits num B-V points into slices of as many points as fit in max_elements when
+    # each point takes elements. Only a star with very uncertain B-V needs more than one
+    def bv_slices(self,num,elements):
+        size = max(1,self.max_elements//max(1,elements))
+        return [slice(k,k+size) for k in range(0,num,size)]
+
+    #Scratch array called name with the given shape and dtype. Each name keeps one flat array
+    # that grows to the largest size asked for, at most about max_elements, so the loops of
+    # likelihoods reuse the same memory instead of allocating temporaries for every chunk.
+    # The contents are whatever the last user left there
+    def buffer(self,name,shape,dtype=float):
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        buf = self.buffers.get((name,dtype))
+        if buf is None or len(buf) < size:
+            buf = self.buffers[(name,dtype)] = np.empty(size,dtype=dtype)
+        return buf[:size].reshape(shape)
+
+    #median log(Li EW) at B-V points bv + bv_err*z with axes (star,BV,AGE), in the 'mu' buffer
+    def bv_points_mu(self,bv,bv_err,z,dtype=float):
+        BV = bv.reshape(-1,1) + bv_err.reshape(-1,1)*z
+        shape = (BV.size,len(self.age))
+        mu = self.median_interp(BV,dtype=dtype,out=self.buffer('mu',shape,dtype),
+                                work=self.buffer('work',shape,dtype))
+        return mu.reshape(len(bv),len(z),-1)
+
+    # Vectorized likelihood for arrays of stars, returning an N x len(AGE) matrix.
+    # Stars are grouped by the number of B-V points and evaluated in chunks of stars and of
+    # B-V points so that the temporaries stay below max_elements, with the sums over B-V
+    # accumulated in final_sum. With engine='exact' the integral over Li EW and the sum over
+    # B-V are one contraction of the pdf_fit values on (stars,BV,AGE,Li), otherwise the
+    # integral goes through kernel_sums.
+    # dtype (the estimator's dtype by default) is the precision of the result and of the
+    # (stars,BV,AGE) arrays, except that the exact engine works in float64
+    # cache=False skips the estimator's likelihood_cache. num_points gives the B-V points of
+    # each star, otherwise they come from bv_tolerance or bv_point_count
+    def likelihoods(self,bv_arr,bv_errs,metallicity_arr,measure_err_arr=None,upperLim_arr=None,
+                    dtype=None,cache=True,num_points=None):
+        num = len(metallicity_arr)
+        dtype = np.dtype(dtype) if dtype else self.dtype
+        metallicity_arr = np.asarray(metallicity_arr,dtype=float)
+        if self.metal == 'calcium':
+            return self.pdf_fit(metallicity_arr.reshape(-1,1) - self.grid_median[0]).astype(dtype)
 
-        astro_gauss = self.pdf_fit(np.log10(METAL) - mu)/METAL
-        product = li_gauss*astro_gauss
-        integral = np.trapz(product,METAL,axis=2) # now 2d matrix
-        final_sum = np.sum(integral,axis=0)
+        bv_arr = np.asarray(bv_arr,dtype=float)
+        if bv_errs is None: bv_errs = [None]*num
+        if measure_err_arr is None: measure_err_arr = [None]*num
+        if upperLim_arr is None: upperLim_arr = [False]*num
+        bv_errs = np.array([e if e else self.const.BV_UNCERTAINTY for e in bv_errs],dtype=float)
+        measure_err_arr = np.array([e if e else self.const.MEASURE_ERR \
+                                    for e in measure_err_arr],dtype=float)
+        upperLim_arr = np.array(upperLim_arr,dtype=bool)
+        if cache and self.likelihood_cache is not None:
+            return self.cached_likelihoods(bv_arr,bv_errs,metallicity_arr,measure_err_arr,
+                                           upperLim_arr,dtype)
+
+        if num_points is None and self.bv_tolerance:
+            return self.converged_likelihoods(bv_arr,bv_errs,metallicity_arr,measure_err_arr,
+                                              upperLim_arr,dtype)
+        if num_points is None:
+            num_points = self.bv_point_count(bv_errs)
+
+        num_age = len(self.age)
+        final_sum = np.zeros((num,num_age),dtype=dtype)
+        work = np.dtype(np.float64) if self.engine == 'exact' else dtype
+        log_li = np.log10(metallicity_arr).astype(work)
+        for n in np.unique(num_points):
+            z,w = prob.standard_normal_quadrature(int(n),self.quadrature)
+            w = w.astype(work)
+            group = np.nonzero(num_points == n)[0]
+
+            #all upper limits of a group are done together, whatever their Li EW
+            ul = group[upperLim_arr[group]]
+            cdf_fit = self.cdf_fit if self.engine == 'exact' or self.cdf_lookup is None \
+                      else self.cdf_lookup
+            for chunk in self.star_chunks(ul,n*num_age):
+                for sl in self.bv_slices(n,len(chunk)*num_age):
+                    mu = self.bv_points_mu(bv_arr[chunk],bv_errs[chunk],z[sl],work)
+                    resid = np.subtract(log_li[chunk].reshape(-1,1,1),mu,out=mu)
+                    if cdf_fit is self.cdf_lookup:
+                        cdf = cdf_fit(resid,out=resid,ind=self.buffer('ind',mu.shape,int),
+                                      work=self.buffer('work',mu.shape,work))
+                    else:
+                        cdf = cdf_fit(resid)
+                    final_sum[chunk] += np.einsum('ijk,j->ik',cdf,w[sl])
+
+            det = group[~upperLim_arr[group]]
+            #grouping stars by node spacing and then sorting by Li keeps the grid shared by
+            # the stars of a chunk small. Stars without a window have zero likelihood
+            lo,hi,h = self.li_windows(metallicity_arr[det],measure_err_arr[det])
+            order = np.lexsort((metallicity_arr[det],np.floor(np.log2(h))))
+            order = order[hi[order] > lo[order]]
+            det,lo,hi,h = det[order],lo[order],hi[order],h[order]
+            num_nodes = lambda i,j: int(np.ceil((max(hi[i:j]) - min(lo[i:j]))/min(h[i:j]))) + 1
+            own_nodes = np.ceil((hi - lo)/h) + 1
+            #elements per star and B-V point
+            width = lambda i,j: num_age*(1 if self.engine != 'exact' else num_nodes(i,j))
+            i = 0
+            while i < len(det):
+                j = i + 1
+                #a chunk also ends where sharing the grid would need LI_GRID_GROWTH times the
+                # nodes its stars need on their own
+                while j < len(det) and (j - i + 1)*max(n*width(i,j+1),num_nodes(i,j+1)) \
+                        <= self.max_elements and \
+                        num_nodes(i,j+1) <= LI_GRID_GROWTH*max(own_nodes[i:j+1]):
+                    j += 1
+                chunk = det[i:j]
+                u,li_weights = self.li_nodes(metallicity_arr[chunk],measure_err_arr[chunk])
+                for sl in self.bv_slices(n,(j - i)*width(i,j)):
+                    mu = self.bv_points_mu(bv_arr[chunk],bv_errs[chunk],z[sl],work)
+                    if self.engine != 'exact':
+                        final_sum[chunk] += self.kernel_sums(li_weights,u,mu,w[sl])
+                    else:
+                        astro_gauss = self.pdf_fit(u - mu.reshape(j-i,mu.shape[1],-1,1))
+                        final_sum[chunk] += np.einsum('ibak,ik,b->ia',astro_gauss,li_weights,
+                                                      w[sl],optimize=True)
+                i = j
         return final_sum
 
+    #likelihoods with the B-V points of each star doubled until its normalized likelihood
+    # moves by less than bv_tolerance in L1, or it reaches max_bv_points. The doubled
+    # likelihood of the last step is kept, so the error is usually well below bv_tolerance
+    def converged_likelihoods(self,bv_arr,bv_errs,li_arr,measure_err_arr,upperLim_arr,dtype):
+        args = (bv_arr,bv_errs,li_arr,measure_err_arr,upperLim_arr)
+        most = self.max_bv_points()
+        num_points = np.full(len(li_arr),min(BV_TOLERANCE_START,most))
+        like = self.likelihoods(*args,dtype=dtype,cache=False,num_points=num_points)
+        todo = np.nonzero(num_points < most)[0]
+        while len(todo):
+            num_points[todo] = np.minimum(2*num_points[todo],most)
+            finer = self.likelihoods(*[a[todo] for a in args],dtype=dtype,cache=False,
+                                     num_points=num_points[todo])
+            coarse = like[todo]
+            with np.errstate(invalid='ignore',divide='ignore'):
+                change = np.trapz(np.abs(coarse/np.trapz(coarse,self.age).reshape(-1,1) -
+                                         finer/np.trapz(finer,self.age).reshape(-1,1)),self.age)
+            like[todo] = finer
+            todo = todo[(change > self.bv_tolerance) & (num_points[todo] < most)]
+        return like
+
+    #likelihoods through likelihood_cache: the stars found there are copied from it and the
+    # rest are computed in one call and stored. Stars that round to the same key share a row
+    def cached_likelihoods(self,bv_arr,bv_errs,li_arr,measure_err_arr,upperLim_arr,dtype):
+        cache = self.likelihood_cache
+        keys = cache.keys((self.likelihood_fingerprint(),dtype.str),bv_arr,li_arr,bv_errs,
+                          measure_err_arr,upperLim_arr)
+        result = np.empty((len(keys),len(self.age)),dtype=dtype)
+        missing = OrderedDict() #key -> stars with it
+        for k,key in enumerate(keys):
+            row = cache.get(key)
+            if row is None:
+                missing.setdefault(key,[]).append(k)
+            else:
+                result[k] = row
+        if missing:
+            first = [stars[0] for stars in missing.values()]
+            like = self.likelihoods(bv_arr[first],bv_errs[first],li_arr[first],
+                                    measure_err_arr[first],upperLim_arr[first],dtype,cache=False)
+            for (key,stars),row in zip(missing.items(),like):
+                result[stars] = row
+                cache.put(key,row.copy())
+        return result
+
+    #md5 of what a star likelihood depends on besides the star: the median grid, the ages,
+    # the likelihood fit and the settings of the integral. Prefix of the likelihood_cache keys
+    # The md5 of the arrays is kept as grid_hash until set_grids, with_age or loading the fit
+    # clears it, so a grid changed in place needs grid_hash = None too
+    def likelihood_fingerprint(self):
+        if self.grid_hash is None:
+            self.grid_hash = utils.array_hash(self.grid_median,self.age,self.pdf_fit.x,
+                                    self.pdf_fit.y,self.cdf_fit.x,self.cdf_fit.y)
+        settings = (self.engine,self.quadrature,self.num_bv_points,self.li_tolerance,
+                    self.bv_tolerance)
+        return self.grid_hash + repr(settings)
+
+    # The integral over Li EW of each star is done in u = log10(EW), where the integrand is
+    # ln(10)*gaussian(10^u,li,measure_err)*pdf_fit(u - mu) since the 1/EW of the likelihood
+    # cancels the Jacobian. Its window is where the measurement gaussian exceeds FIVE_SIGMAS,
+    # within the range of METAL, and the trapezoid rule there with nodes h apart has two
+    # errors: about (h/pdf_width)**2/12 from the curvature of pdf_fit, and about
+    # exp(-2*(pi*sigma_u/h)**2) from the gaussian, which is sigma_u = measure_err/(EW ln 10)
+    # wide in u at the top of the window. h keeps both below li_tolerance, so stars with
+    # narrow errors get few nodes and small errors at low EW are still resolved. h is rounded
+    # down to a power of 2 so the nodes of every star lie on one lattice, see li_nodes.
+    # Returns the ends of the windows in u and the node spacing of each star
+    def li_windows(self,li,measure_err):
+        METAL = self.const.METAL.ravel()
+        li = np.asarray(li,dtype=float).ravel()
+        measure_err = np.asarray(measure_err,dtype=float).ravel()
+        peak = prob.FIVE_SIGMAS*measure_err*np.sqrt(2*np.pi) #FIVE_SIGMAS over the peak height
+        d = measure_err*np.sqrt(-2*np.log(np.minimum(peak,1)))
+        lo = np.log10(np.maximum(li - d,METAL[0]))
+        hi = np.log10(np.clip(li + d,METAL[0],METAL[-1]))
+        sigma_u = measure_err/(np.power(10,hi)*np.log(10))
+        tol = self.li_tolerance
+        h = np.minimum(self.pdf_width*np.sqrt(12*tol),np.pi*sigma_u*np.sqrt(2/np.log(1/tol)))
+        return lo,hi,np.power(2,np.floor(np.log2(h)))
+
+    # Nodes u of a grid uniform in log10(EW) shared by the stars with Li EW li and errors
+    # measure_err, spanning their windows with the finest spacing any of them needs, and the
+    # weights of each star on it: its trapezoid weights within its window times
+    # ln(10)*gaussian(10^u,li,measure_err), zero outside. The integral over Li EW of a star
+    # is then the dot product of its weights with pdf_fit(u - mu). The nodes are the
+    # multiples of the finest spacing, and each star only weighs the multiples of its own
+    # spacing h, so its integral does not depend on the stars it shares the grid with
+    def li_nodes(self,li,measure_err):
+        li = np.asarray(li,dtype=float).reshape(-1,1)
+        measure_err = np.asarray(measure_err,dtype=float).reshape(-1,1)
+        lo,hi,h = self.li_windows(li,measure_err)
+        has_window = hi > lo
+        if not np.any(has_window):
+            return np.log10(self.const.METAL.ravel()[[0,-1]]),np.zeros((len(li),2))
+        du = np.min(h[has_window])
+        k = np.arange(np.floor(np.min(lo[has_window])/du),np.ceil(np.max(hi[has_window])/du) + 1)
+        u = du*k
+        stride = (h/du).reshape(-1,1) #nodes of the grid per node of the star
+        first = stride*np.ceil(lo.reshape(-1,1)/h.reshape(-1,1) - 1e-9)
+        last = stride*np.floor(hi.reshape(-1,1)/h.reshape(-1,1) + 1e-9)
+        own = (k % stride == 0) & (k >= first) & (k <= last)
+        trapz = h.reshape(-1,1)*own - h.reshape(-1,1)/2*(own & ((k == first) | (k == last)))
+        trapz[(last - first < stride).ravel()] = 0
+        return u,trapz*np.log(10)*prob.gaussian(np.power(10,u),li,measure_err)
+
+    # Integral over Li EW at each value of mu_grid, for the nodes u and weights li_weights
+    # from li_nodes. mu_grid is done in slices that keep the (node,mu) array within
+    # max_elements
+    def li_kernel(self,li_weights,u,mu_grid):
+        kernel = np.zeros((len(li_weights),len(mu_grid)))
+        step = max(1,self.max_elements//max(1,len(u)))
+        for k in range(0,len(mu_grid),step):
+            astro_gauss = self.pdf_fit(u.reshape(-1,1) - mu_grid[k:k+step])
+            kernel[:,k:k+step] = np.dot(li_weights,astro_gauss)
+        return kernel
+
+    # For a fixed star the li_kernel depends on mu alone, so it is computed once on a grid of
+    # mu spaced KERNEL_MU_STEP apart and interpolated at mu(B-V,AGE), which has axes
+    # (star,BV,AGE). Returns the sums over B-V with the quadrature weights. mu is overwritten
+    def kernel_sums(self,li_weights,u,mu,weights):
+        step = self.const.KERNEL_MU_STEP
+        mu_min,mu_max = np.min(mu),np.max(mu)
+        support = getattr(self.pdf_fit,'x',None)
+        if support is not None: #kernel is zero where all residuals are off the fit
+            mu_min = max(mu_min,u[0] - support[-1])
+            mu_max = min(mu_max,u[-1] - support[0])
+        if mu_min > mu_max:
+            return np.zeros((mu.shape[0],mu.shape[2]))
+        start = np.floor(mu_min/step)
+        mu_grid = step*np.arange(start,np.ceil(mu_max/step) + 1)
+        kernel = self.li_kernel(li_weights,u,mu_grid)
+        mu /= step
+        mu -= start
+        return self.interp_kernel_sums(kernel,mu,weights)
+
+    # Linear interpolation of each row of kernel at fractional indices x with axes
+    # (star,BV,AGE), zero off the ends of the kernel. Returns the sums over B-V with the
+    # quadrature weights. Works in place on x and the scratch buffers
+    def interp_kernel_sums(self,kernel,x,weights):
+        n = kernel.shape[1]
+        padded = self.buffer('padded',(len(kernel),n + 2),x.dtype)
+        padded[:,0] = padded[:,-1] = 0
+        padded[:,1:-1] = kernel
+        x += 1
+        np.clip(x,0,n + 1,out=x)
+        ind = self.buffer('ind',x.shape,int)
+        np.copyto(ind,x,casting='unsafe')
+        np.minimum(ind,n,out=ind)
+        x -= ind #x is now the fraction of the way to the next point
+        ind += (n + 2)*np.arange(len(kernel)).reshape(-1,1,1)
+        left = padded.ravel().take(ind,out=self.buffer('work',x.shape,x.dtype),mode='clip')
+        right = padded.ravel()[1:].take(ind,out=self.buffer('right',x.shape,x.dtype),
+                                        mode='clip')
+        right -= left
+        right *= x
+        left += right
+        return np.einsum('ijk,j->ik',left,weights)
+
+    #Files a precomputed table depends on, with a hash of each to detect when they change
+    def table_sources(self):
+        files = [self.grid_file,join(GRIDDIR,self.metal + '_likelihood_fit.npy')]
+        return {basename(f):utils.file_hash(f) for f in files}
+
+    #Precomputes log-posteriors (uniform prior) and their stats on a dense grid of R'HK
+    # spaced TABLE_RHK_STEP apart. The posteriors are saved to grids/ as a float32 .npy that
+    # is memory-mapped when loaded, the axis, stats and sources go in a pickle beside it
+    def make_posterior_table(self,saveToFile=True):
+        assert self.metal == 'calcium', "Posterior tables are only made for calcium"
+        assert self.default_age(), "Posterior tables are only made on the default age grid"
+        step = self.const.TABLE_RHK_STEP
+        rhk = np.linspace(self.const.METAL_RANGE[0],self.const.METAL_RANGE[1],
+                int(round((self.const.METAL_RANGE[1] - self.const.METAL_RANGE[0])/step)) + 1)
+        with np.errstate(divide='ignore'):
+            log_post = np.log(self.likelihoods(None,None,rhk))
+        log_post[np.all(log_post == -np.inf,axis=1)] = 0
+        prob.log_normalize(self.age,log_post)
+        stats = prob.stats_batch(self.age,log_post,log=True)
+        log_post = np.maximum(log_post,LOG_ZERO).astype(np.float32)
+
+        info = {'version':TABLE_VERSION,'sources':self.table_sources(),'rhk':rhk,'stats':stats}
+        if saveToFile:
+            name = join(GRIDDIR,self.metal + '_posterior_table')
+            np.save(name,log_post)
+            pickle.dump(info,open(name + '.p','wb+'))
+        self.posterior_table = (info,log_post)
+        return self.posterior_table
+
+    #loads the saved posterior table if it was made from the current grid and likelihood fit
+    def load_posterior_table(self):
+        self.posterior_table = None
+        name = join(GRIDDIR,self.metal + '_posterior_table')
+        if self.grid_file is None or not self.default_age() or not exists(name + '.p') or \
+                not exists(name + '.npy'):
+            return None
+        info = pickle.load(open(name + '.p','rb'))
+        if info['version'] != TABLE_VERSION or info['sources'] != self.table_sources():
+            print("Posterior table %s is out of date, run refresh.py to rebuild it" % name)
+            return None
+        self.posterior_table = (info,np.load(name + '.npy',mmap_mode='r'))
+        return self.posterior_table
+
+    #Interpolates the posterior table in log space at each value of rhk. Returns the
+    # posteriors and their stats, which are interpolated too if there is no maxAge.
+    # With log=True the logs of the posteriors are returned, -inf where they are zero.
+    # LOG_ZERO never leaves the table: an age that is zero at either end of the interval
+    # is zero in between, as the exp of the interpolated logs would be
+    def table_posterior(self,rhk,maxAge=None,log=False):
+        info,log_post = self.posterior_table
+        axis = info['rhk']
+        x = (np.atleast_1d(rhk) - axis[0])/(axis[1] - axis[0])
+        i = np.clip(x.astype(int),0,len(axis) - 2)
+        t = (x - i).reshape(-1,1)
+        y = (1 - t)*log_post[i] + t*log_post[i+1]
+        zero = ((log_post[i] <= LOG_ZERO/2) & (t != 1)) | ((log_post[i+1] <= LOG_ZERO/2) & (t != 0))
+        y[zero] = -np.inf
+        stats = None
+        if maxAge is None or maxAge >= self.const.GALAXY_AGE:
+            stats = (1 - t)*info['stats'][i] + t*info['stats'][i+1]
+        else:
+            y += self.log_prior(maxAge)
+        if not log:
+            y = np.exp(y,out=y)
+        if np.ndim(rhk) == 0:
+            y = y[0]
+            stats = stats[0] if stats is not None else None
+        return y,stats
+
+    #Precomputes the lithium stats at the default BV_UNCERTAINTY and MEASURE_ERR on a grid of
+    # B-V and log(Li EW) spaced TABLE_BV_STEP and TABLE_LOGLI_STEP apart, for detections and
+    # upper-limits. The interpolation error of each cell is measured at its center, where
+    # bilinear interpolation of smooth stats is worst, and the largest of it over the cell and
+    # its neighbors times STATS_TABLE_SAFETY is kept as the cell's error estimate,
+    # info['cell_error'][upperLim]. It is not a bound: the stats have kinks, and stars inside
+    # a cell can be up to about twice as far off as its center. The error of get_stats, which
+    # is exact in cells above STATS_TABLE_TOLERANCE, is measured on num_check random stars and
+    # kept as the largest relative error in age of any stat, info['error']
+    def make_stats_table(self,saveToFile=True,num_check=2000,seed=0):
+        assert self.metal == 'lithium', "Stats tables are only made for lithium"
+        assert self.default_age(), "Stats tables are only made on the default age grid"
+        bv = np.linspace(self.const.BV_RANGE[0],self.const.BV_RANGE[1],int(round(
+            (self.const.BV_RANGE[1] - self.const.BV_RANGE[0])/self.const.TABLE_BV_STEP)) + 1)
+        log_li = np.linspace(self.const.METAL_RANGE[0],self.const.METAL_RANGE[1],int(round(
+            (self.const.METAL_RANGE[1] - self.const.METAL_RANGE[0])/self.const.TABLE_LOGLI_STEP))+1)
+        BV,LI = [x.ravel() for x in np.meshgrid(bv,log_li,indexing='ij')]
+        info = {'version':TABLE_VERSION,'sources':self.table_sources(),'bv':bv,'log_li':log_li}
+        for upperLim in [False,True]:
+            post = self.get_posteriors(BV,np.power(10,LI),upperLim_arr=[upperLim]*len(BV))
+            stats = prob.stats_batch(self.age,post,upperLim=upperLim)
+            info[upperLim] = np.log10(stats).reshape(len(bv),len(log_li),-1).astype(np.float32)
+
+        BV,LI = [x.ravel() for x in np.meshgrid((bv[1:] + bv[:-1])/2,(log_li[1:] + log_li[:-1])/2,
+                                                indexing='ij')]
+        info['cell_error'] = np.zeros((2,len(bv) - 1,len(log_li) - 1),dtype=np.float32)
+        self.stats_table = info
+        for upperLim in [False,True]:
+            post = self.get_posteriors(BV,np.power(10,LI),upperLim_arr=[upperLim]*len(BV))
+            exact = prob.stats_batch(self.age,post,upperLim=upperLim)
+            approx = self.get_stats(BV,np.power(10,LI),upperLim)
+            err = np.nanmax(np.abs(approx - exact)/exact,axis=1).reshape(len(bv) - 1,-1)
+            padded = np.pad(err,1,mode='edge')
+            info['cell_error'][int(upperLim)] = self.const.STATS_TABLE_SAFETY*np.max(
+                    [padded[a:a+err.shape[0],b:b+err.shape[1]] for a in range(3) for b in range(3)],
+                    axis=0)
+
+        rng = np.random.default_rng(seed)
+        bv_check = rng.uniform(bv[0],bv[-1],num_check)
+        li_check = np.power(10,rng.uniform(log_li[0],log_li[-1],num_check))
+        info['error'] = 0
+        for upperLim in [False,True]:
+            post = self.get_posteriors(bv_check,li_check,upperLim_arr=[upperLim]*num_check)
+            exact = prob.stats_batch(self.age,post,upperLim=upperLim)
+            approx = self.get_stats(bv_check,li_check,upperLim)
+            info['error'] = max(info['error'],np.nanmax(np.abs(approx - exact)/exact))
+
+        if saveToFile:
+            pickle.dump(info,open(join(GRIDDIR,self.metal + '_stats_table.p'),'wb+'))
+        return info
+
+    #loads the saved stats table if it was made from the current grid and likelihood fit
+    def load_stats_table(self):
+        self.stats_table = None
+        name = join(GRIDDIR,self.metal + '_stats_table.p')
+        if self.grid_file is None or not self.default_age() or not exists(name):
+            return None
+        info = pickle.load(open(name,'rb'))
+        if info['version'] != TABLE_VERSION or info['sources'] != self.table_sources():
+            print("Stats table %s is out of date, run refresh.py to rebuild it" % name)
+            return None
+        self.stats_table = info
+        return info
+
+    #Returns the stats (see prob.stats) for stars with the default uncertainties, without
+    # making their posteriors when a precomputed table is loaded. Li EW is linear in mA.
+    # With the lithium table, stars in cells whose error (see make_stats_table) is above
+    # STATS_TABLE_TOLERANCE get the stats of their posteriors instead, and stats_table['error']
+    # is the largest relative error measured at build time. With return_error the estimated
+    # relative error of the cell of each star is returned too, 0 where the stats are not
+    # interpolated and nan for the calcium table
+    def get_stats(self,bv,metallicity,upperLim=False,return_error=False):
+        scalar = np.ndim(metallicity) == 0
+        metallicity = np.atleast_1d(np.asarray(metallicity,dtype=float))
+        error = np.zeros(len(metallicity))
+        exact = np.ones(len(metallicity),dtype=bool) #stars whose posteriors are made
+        if self.metal == 'calcium' and self.posterior_table is not None:
+            stats = self.table_posterior(metallicity)[1]
+            exact[:] = False
+            error[:] = np.nan #not measured for the calcium table
+        elif self.metal == 'lithium' and self.stats_table is not None:
+            table = self.stats_table
+            bv = np.atleast_1d(np.asarray(bv,dtype=float))
+            x = (bv - table['bv'][0])/(table['bv'][1] - table['bv'][0])
+            y = (np.log10(metallicity) - table['log_li'][0])/ \
+                    (table['log_li'][1] - table['log_li'][0])
+            i = np.clip(x.astype(int),0,len(table['bv']) - 2)
+            j = np.clip(y.astype(int),0,len(table['log_li']) - 2)
+            s,t = (x - i).reshape(-1,1),(y - j).reshape(-1,1)
+            grid = table[bool(upperLim)]
+            stats = np.power(10,(1-s)*(1-t)*grid[i,j] + (1-s)*t*grid[i,j+1] + \
+                                s*(1-t)*grid[i+1,j] + s*t*grid[i+1,j+1])
+            error = table['cell_error'][int(bool(upperLim))][i,j].astype(float)
+            exact = error > self.const.STATS_TABLE_TOLERANCE
+            error[exact] = 0
+        if np.any(exact):
+            if bv is not None:
+                bv = np.broadcast_to(np.asarray(bv,dtype=float),metallicity.shape)[exact]
+            post = self.get_posteriors(bv,metallicity[exact],upperLim_arr=[upperLim]*np.sum(exact))
+            exact_stats = prob.stats_batch(self.age,post,upperLim=upperLim)
+            if np.all(exact):
+                stats = exact_stats
+            else:
+                stats[exact] = exact_stats
+        if scalar:
+            stats,error = stats[0],error[0]
+        return (stats,error) if return_error else stats
+
     #calculates and returns a 2D array of median b-v and age
     #omit_cluster specifies a cluster index to remove from the fits to make the grids without a cluster
     def make_grids(self,bv_li,fits,upper_lim=None,medianSavefile=None,\
@@ -320,7 +1435,8 @@ class age_estimator:
         if (setAsDefaults):
             self.set_default_grids(medianSavefile)
 
-        self.grid_median = median_rhk
+        self.set_grids(median_rhk)
+        self.grid_file = medianSavefile + '.npy' if medianSavefile else None
 
     #given an x_value, which is the location to evaluate and an array of fits,
     #it calculates the y-value at x_val for each fit and returns an array of them
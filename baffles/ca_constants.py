@@ -37,6 +37,7 @@ METAL = prob.polyspace(METAL_RANGE[0],METAL_RANGE[1],1000) #the axis of the 2D a
 AGE = np.logspace(0,np.log10(GALAXY_AGE),1000) #in units of Myr
 BV_UNCERTAINTY = None #B-V not incorporated into fits
 MEASURE_ERR = None #no default uncertainty in measurement
+TABLE_RHK_STEP = 0.0025 #spacing of the precomputed posterior table made by baffles.py
 
 #Fits as a function of age.
 #If path dividers are different on your operating system, run "python refresh.py"
@@ -8,7 +8,7 @@ import numpy as np
 from numpy import genfromtxt
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
-from scipy import interpolate,integrate
+from scipy import integrate
 from scipy.stats import t as scipy_t
 from scipy.stats import norm
 from scipy.optimize import minimize,curve_fit
@@ -324,7 +324,124 @@ def inverse_log_likelihood(r_model,sig_model,r,upper_lim):
 #returns an array for the y_values at the locations specified by x
 #x_locs is increasing
 def piecewise(x_locs,y_locs):
-        return interpolate.interp1d(x_locs,y_locs, fill_value='extrapolate')
+        return piecewise_linear(x_locs,y_locs)
+
+#piecewise linear function through the points (x,y) that extrapolates the end segments, the
+# same as interp1d(x,y,fill_value='extrapolate') but cheap to make and to call. Unsorted x
+# are put in order with a stable sort like interp1d does. On uniformly spaced x the segment
+# of each value is found by index arithmetic, otherwise by searchsorted
+class piecewise_linear:
+    __slots__ = ['x','y','slope','scale']
+
+    def __init__(self,x,y):
+        x = np.asarray(x,dtype=float).ravel()
+        y = np.asarray(y,dtype=float).ravel()
+        assert len(x) == len(y) and len(x) >= 2, "piecewise_linear needs 2 or more points"
+        dx = x[1:] - x[:-1]
+        if dx.min() < 0:
+            order = np.argsort(x,kind='mergesort')
+            x,y = x[order],y[order]
+            dx = x[1:] - x[:-1]
+        self.x,self.y = x,y
+        dx_min,dx_max = dx.min(),dx.max()
+        #segments of repeated x are unused and those of subnormal width, like the tail steps
+        # of a cdf, overflow. interp1d only divides for the segments it looks up
+        with np.errstate(over='ignore',divide='ignore',invalid='ignore'):
+            self.slope = (y[1:] - y[:-1])/dx
+        span = x[-1] - x[0]
+        self.scale = len(dx)/span if dx_max - dx_min <= 1e-9*span/len(dx) and span > 0 else None
+
+    def __call__(self,x_new):
+        x_new = np.asarray(x_new,dtype=float)
+        shape = x_new.shape #kept so a scalar gives a 0-d array like interp1d
+        x_new = x_new.ravel()
+        if self.scale is not None:
+            i = np.subtract(x_new,self.x[0])
+            i *= self.scale
+            np.clip(i,0,len(self.x) - 2,out=i)
+            i = np.nan_to_num(i,copy=False).astype(int) #nan x_new give nan y_new from any segment
+        else:
+            i = np.searchsorted(self.x,x_new) - 1
+            np.clip(i,0,len(self.x) - 2,out=i)
+        y_new = np.subtract(x_new,self.x.take(i))
+        y_new *= self.slope.take(i)
+        y_new += self.y.take(i)
+        return y_new.reshape(shape)
+
+#linear interpolation of a grid with rows along y_axis (B-V) and columns along x_axis (age).
+#Ages are almost always requested on x_axis itself, so evaluating a B-V only blends the two
+# neighboring rows. Like interp2d, values outside the grid take the value of the nearest edge.
+# Unlike interp2d the output keeps the order of the requested y values.
+class grid_interp:
+    def __init__(self,y_axis,x_axis,grid):
+        self.y_axis = np.asarray(y_axis,dtype=float).ravel()
+        self.x_axis = np.asarray(x_axis,dtype=float).ravel()
+        self.grid = np.asarray(grid,dtype=float).reshape(len(self.y_axis),len(self.x_axis))
+        self.slope = np.diff(self.grid,axis=0)
+        self.cast = {} #grid and slope in each dtype asked for
+
+    #returns array of shape (len(y),len(x_axis)), or (len(y),) values at age x if x is given
+    # dtype sets the precision the rows are blended in. Without x, out and work may be given
+    # as arrays of the output shape and dtype to hold the result and a temporary
+    def __call__(self,y,x=None,dtype=float,out=None,work=None):
+        dtype = np.dtype(dtype)
+        if dtype not in self.cast:
+            self.cast[dtype] = (self.grid.astype(dtype),self.slope.astype(dtype))
+        grid,slope = self.cast[dtype]
+        if x is not None:
+            grid = np.array([np.interp(x,self.x_axis,row) for row in self.grid],
+                            dtype=dtype).reshape(-1,1)
+            slope = np.diff(grid,axis=0)
+            out = work = None
+        y = np.atleast_1d(np.asarray(y,dtype=float)).ravel()
+        if out is None:
+            out = np.empty((len(y),grid.shape[1]),dtype=grid.dtype)
+        if len(self.y_axis) == 1:
+            out[:] = grid
+        else:
+            i = np.searchsorted(self.y_axis,y,side='right') - 1
+            i = np.clip(i,0,len(self.y_axis) - 2)
+            t = (y - self.y_axis[i])/(self.y_axis[i+1] - self.y_axis[i])
+            t = np.clip(t,0,1).reshape(-1,1).astype(grid.dtype)
+            if work is None:
+                work = np.empty_like(out)
+            np.take(grid,i,axis=0,out=out)
+            np.take(slope,i,axis=0,out=work)
+            work *= t
+            out += work
+        return out[:,0] if x is not None else out
+
+#linear interpolation of func resampled on a uniform grid from x_min to x_max spaced about
+# step apart. Lookups are found by index arithmetic instead of a search. Values outside the
+# grid take the value of the nearest edge, which suits a cdf that is flat past its ends.
+class uniform_interp:
+    def __init__(self,func,x_min,x_max,step):
+        num = int(round((x_max - x_min)/step)) + 1
+        self.x = np.linspace(x_min,x_max,num)
+        self.y = np.asarray(func(self.x),dtype=float)
+        self.slope = np.diff(self.y)
+        self.scale = (num - 1)/(x_max - x_min)
+        self.cast = {np.dtype(float):(self.y,self.slope)} #y and slope in each input dtype
+
+    #float32 input is interpolated in float32. out (which may be x itself) holds the result,
+    # ind an int array and work a float array of the same shape hold the temporaries
+    def __call__(self,x,out=None,ind=None,work=None):
+        x = np.asarray(x)
+        if x.dtype != np.float32:
+            x = x.astype(float,copy=False)
+        if x.dtype not in self.cast:
+            self.cast[x.dtype] = (self.y.astype(x.dtype),self.slope.astype(x.dtype))
+        y,slope = self.cast[x.dtype]
+        x = np.subtract(x,float(self.x[0]),out=out)
+        x *= self.scale
+        np.clip(x,0,len(self.x) - 1,out=x)
+        i = np.empty(x.shape,dtype=int) if ind is None else ind
+        np.copyto(i,x,casting='unsafe')
+        np.minimum(i,len(self.x) - 2,out=i)
+        x -= i
+        x *= slope.take(i,out=work,mode='clip')
+        x += y.take(i,out=work,mode='clip')
+        return x
 
 #x_locs defines the discontinuities,y_locs defines heights of step function
 # length of x_locs is 1 fewer than y_locs
@@ -376,7 +493,7 @@ def magic_table_convert(in_column,out_column):
         except:
             continue
 
-    return interpolate.interp1d(x,y, fill_value='extrapolate')
+    return piecewise(x,y)
 
 def spt_bv():
     t = ascii.read(join(DATADIR, 'mamajek_magic_table.txt'))
@@ -388,7 +505,7 @@ def spt_bv():
         sp.append(float(spt[i][1:]) + 10*letters.index(spt[i][0]))
         bv.append(float(t[i][6]))
 
-    interp = interpolate.interp1d(sp,bv, fill_value='extrapolate')
+    interp = piecewise(sp,bv)
     #plt.plot(bv,sp)
     def f(x):
         return interp(utils.float_sptype(x))
@@ -406,8 +523,8 @@ def teff_to_primli(teff):
         #make my own column via interp
         col = []
         for row in t[1:]:
-            col.append(interpolate.interp1d(t[0][1:], row[1:],fill_value='extrapolate')(temp))
-        arr.append(interpolate.interp1d(col,logEW, fill_value='extrapolate')(PRIMORDIAL_NLI).tolist())
+            col.append(piecewise(t[0][1:], row[1:])(temp))
+        arr.append(piecewise(col,logEW)(PRIMORDIAL_NLI).tolist())
 
     return arr
 
@@ -427,12 +544,12 @@ def teff_nli_to_li(teff,NLI):
         col = []
         if temp <= 4000:
             for row in t2[1:]:
-                col.append(interpolate.interp1d(t2[0][1:], row[1:],fill_value='extrapolate')(nli))
-            arr.append(interpolate.interp1d(temp_axis,col,fill_value='extrapolate')(temp).tolist())
+                col.append(piecewise(t2[0][1:], row[1:])(nli))
+            arr.append(piecewise(temp_axis,col)(temp).tolist())
         else:
             for row in t[1:]:
-                col.append(interpolate.interp1d(t[0][1:], row[1:],fill_value='extrapolate')(temp))
-            arr.append(interpolate.interp1d(col,logEW, fill_value='extrapolate')(nli).tolist())
+                col.append(piecewise(t[0][1:], row[1:])(temp))
+            arr.append(piecewise(col,logEW)(nli).tolist())
     return np.array(arr)
 
 def VI_to_teff(in_column=2,out_column=6):
@@ -448,7 +565,7 @@ def VI_to_teff(in_column=2,out_column=6):
             y.append(b)
         except:
             continue
-    VI = interpolate.interp1d(x,y, fill_value='extrapolate')
+    VI = piecewise(x,y)
     VI2 = lambda x: 9581.1 + -14264*x + 40759*x**2 - 74141*x**3 + 60932*x**4 - 18021*x**5
     return lambda vi: (vi < 1.2) * VI2(vi) + (vi >= 1.2) * VI(vi)
 
@@ -490,8 +607,7 @@ def get_fit_residuals(bv_m,fits,metal,upper_limits=None,li_range=None,age_range=
     allClusters = []
 
     grid_median = np.load(const.DEFAULT_MEDIAN_GRID)
-    mu_interp = interpolate.interp2d(const.AGE,const.BV_S,grid_median) if metal == 'lithium' else \
-                      interpolate.interp1d(const.AGE,grid_median)
+    mu_interp = grid_interp(const.BV_S,const.AGE,grid_median)
 
     for c in range(len(fits)):
         if age_range is not None and not (age_range[0] <= const.CLUSTER_AGES[c]\
@@ -501,11 +617,8 @@ def get_fit_residuals(bv_m,fits,metal,upper_limits=None,li_range=None,age_range=
         arr = [] #holds non UL from cluster i
         resid = None
         if vs_age_fit:
-            resid = None
-            if metal == 'lithium':
-                resid = np.array(bv_m[c][1]) - mu_interp(const.CLUSTER_AGES[c],bv_m[c][0]).flatten()
-            else:
-                resid = np.array(bv_m[c][1]) - mu_interp(const.CLUSTER_AGES[c])
+            bv = bv_m[c][0] if metal == 'lithium' else const.BV_S
+            resid = np.array(bv_m[c][1]) - mu_interp(bv,const.CLUSTER_AGES[c])
         elif linSpace:
             resid = np.power(10,bv_m[c][1]) - np.power(10,fits[c][0](bv_m[c][0]))
         else: #log space
@@ -731,20 +844,17 @@ def MIST_primordial_li(ngc2264_fit=None,fromFile=True, saveToFile=False):
     import li_constants as const
     if (fromFile):
        prim_li = pickle.load(open(join(DATADIR,'mist_primordial_li.p'),'rb'))
-       return interpolate.interp1d(const.BV,prim_li, fill_value='extrapolate')
+       return piecewise(const.BV,prim_li)
 
     teff = magic_table_convert('bv','teff')(const.BV) #convert B-V to Teff
 
     t1 = ascii.read(join(DATADIR,'MIST_iso_1Myr.txt'))
     t5 = ascii.read(join(DATADIR,'MIST_iso_5Myr.txt'))
 
-    star_mass5 = interpolate.interp1d(t5['log_Teff'][0:275],t5['initial_mass'][0:275],\
-            fill_value='extrapolate')(np.log10(teff))
-    Nli5 = 12 + np.log10(interpolate.interp1d(t5['log_Teff'][0:275],t5['surface_li7'][0:275],\
-            fill_value='extrapolate')(np.log10(teff)))
+    star_mass5 = piecewise(t5['log_Teff'][0:275],t5['initial_mass'][0:275])(np.log10(teff))
+    Nli5 = 12 + np.log10(piecewise(t5['log_Teff'][0:275],t5['surface_li7'][0:275])(np.log10(teff)))
 
-    Nli1 = 12 + np.log10(interpolate.interp1d(t1['initial_mass'],t1['surface_li7'],\
-            fill_value='extrapolate')(star_mass5))
+    Nli1 = 12 + np.log10(piecewise(t1['initial_mass'],t1['surface_li7'])(star_mass5))
 
     #convert teff and nli to EW
     deltaEW = teff_nli_to_li(teff,Nli1) - teff_nli_to_li(teff,Nli5)
@@ -754,7 +864,7 @@ def MIST_primordial_li(ngc2264_fit=None,fromFile=True, saveToFile=False):
 
     if (saveToFile):
         pickle.dump(final_li,open(join(DATADIR,'mist_primordial_li.p'),'wb+'))
-    return interpolate.interp1d(const.BV,final_li, fill_value='extrapolate')
+    return piecewise(const.BV,final_li)
 
 
 
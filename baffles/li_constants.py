@@ -42,6 +42,13 @@ METAL = prob.polyspace(0.5,10**METAL_RANGE[1],1000).reshape(1,1,1000)
 BV_UNCERTAINTY = 0.01
 NUM_BV_POINTS = 15 #Number of points to represent measurement gaussian in baffles.likelihood
 MEASURE_ERR = 15 #mA
+TABLE_BV_STEP = 0.0025 #spacings of the precomputed stats table made by baffles.py
+TABLE_LOGLI_STEP = 0.02
+STATS_TABLE_TOLERANCE = 0.01 #relative error of a stats table cell above which get_stats is exact
+STATS_TABLE_SAFETY = 3 #factor on the error measured at the cell centers of the stats table
+KERNEL_MU_STEP = 0.002 #log(EW) spacing of the likelihood kernel in baffles.kernel_sums
+LI_TOLERANCE = 1e-4 #relative error allowed in the integral over Li EW, sets the nodes per star
+CDF_LOOKUP_STEP = 0.0005 #residual spacing of the cdf_fit lookup for upper limits
 
 #including new general piecewise li_vs_age
 DEFAULT_MEDIAN_GRID = join(GRIDDIR, "median_li_061620.npy")
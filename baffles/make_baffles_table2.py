@@ -174,6 +174,8 @@ def make_table(MR = False):
     fMR.write(delimiterMR.join(units))
     fMR.write('\n')
 
+    #first pass reads the rows, then the posteriors and stats of all stars are computed at once
+    rows = []
     for row in final_table:
         arr = []
         arrMR = []
@@ -184,13 +186,12 @@ def make_table(MR = False):
         arr.append("%.2f" % bv)
         arrMR.append("%.3g" % bv)
 
-        p_ca,p_li = None,None
+        rhk = None
         if utils.isFloat(row[5]):
-            rhk = float(row[5])
-            arr.append('$%.2f$' % rhk)
-            arrMR.append('%.3f' % rhk)
-            if ca_const.inRange(bv,rhk):
-                p_ca = baf_ca.get_posterior(bv,rhk,showPlot=False)
+            arr.append('$%.2f$' % float(row[5]))
+            arrMR.append('%.3f' % float(row[5]))
+            if ca_const.inRange(bv,float(row[5])):
+                rhk = float(row[5])
         else:
             arr.append(empty)
             arrMR.append(empty)
@@ -207,42 +208,40 @@ def make_table(MR = False):
         arr.append(row[7])
         arrMR.append(row[7].replace(',',';'))
 
-        if bv is not None and ew is not None and ew > 0 and li_const.inRange(bv,np.log10(ew)):
-            p_li = baf_li.get_posterior(bv,ew,showPlot=False)
-
-        if p_ca is not None:
-            arr += printStats(p_ca.stats)
-            arrMR += printStats(p_ca.stats,MR=True)
-        else:
-            arr += [empty]*5
-            arrMR += [empty]*5
-
-        if p_li is not None:
-            arr += printStats(p_li.stats)
-            arrMR += printStats(p_li.stats,MR=True)
-        else:
-            arr += [empty]*5
-            arrMR += [empty]*5
-
-
-        if p_ca is None and p_li is None:
+        if not (bv is not None and ew is not None and ew > 0 and li_const.inRange(bv,np.log10(ew))):
+            ew = None
+        if rhk is None and ew is None:
             continue
-
-        if p_ca is not None and p_li is not None:
-            prod = p_ca.array * p_li.array
-            prob.normalize(ca_const.AGE,prod)
-            stats = prob.stats(ca_const.AGE,prod)
-            arr += printStats(stats)
-            arrMR += printStats(stats,MR=True)
-        elif p_ca is not None:
-            arr += printStats(p_ca.stats)
-            arrMR += printStats(p_ca.stats,MR=True)
-        elif p_li is not None:
-            arr += printStats(p_li.stats)
-            arrMR += printStats(p_li.stats,MR=True)
-        else:
-            arr += [empty]*5
-            arrMR += [empty]*5
+        rows.append((arr,arrMR,bv,rhk,ew))
+
+    ca_rows = [k for k,r in enumerate(rows) if r[3] is not None]
+    li_rows = [k for k,r in enumerate(rows) if r[4] is not None]
+    p_ca,p_li = {},{} #row index -> (posterior,stats)
+    if ca_rows:
+        post = baf_ca.get_posteriors([rows[k][2] for k in ca_rows],[rows[k][3] for k in ca_rows])
+        p_ca = dict(zip(ca_rows,zip(post,prob.stats_batch(ca_const.AGE,post))))
+    if li_rows:
+        post = baf_li.get_posteriors([rows[k][2] for k in li_rows],[rows[k][4] for k in li_rows])
+        p_li = dict(zip(li_rows,zip(post,prob.stats_batch(li_const.AGE,post))))
+    both = [k for k in ca_rows if k in p_li]
+    final = {}
+    if both:
+        prod = np.array([p_ca[k][0]*p_li[k][0] for k in both])
+        prob.normalize(ca_const.AGE,prod)
+        final = dict(zip(both,prob.stats_batch(ca_const.AGE,prod)))
+
+    for k,(arr,arrMR,bv,rhk,ew) in enumerate(rows):
+        for p in [p_ca.get(k),p_li.get(k)]:
+            if p is not None:
+                arr += printStats(p[1])
+                arrMR += printStats(p[1],MR=True)
+            else:
+                arr += [empty]*5
+                arrMR += [empty]*5
+
+        stats = final[k] if k in final else (p_ca[k][1] if k in p_ca else p_li[k][1])
+        arr += printStats(stats)
+        arrMR += printStats(stats,MR=True)
 
         f.write(' & '.join(arr) + " \\\\")
         f.write('\n')
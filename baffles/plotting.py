@@ -36,7 +36,7 @@ def posterior(age,y,stat,title=' ',pp=None,showPlot=False,starArray = [],\
             color = cmap(norm(bv_arr[i]))
 
         prob.scale_to_height(post,np.max(y))
-        plt.plot(const.AGE,post,alpha = 1,linewidth=1,color=color,zorder=0)
+        plt.plot(age,post,alpha = 1,linewidth=1,color=color,zorder=0)
 
     if bv_arr is not None:
         sc = plt.scatter([],[],c=[],norm=norm,cmap=cmap)
@@ -573,13 +573,13 @@ def baffles_vs_mamajek(bv_rhk,fits,i,pdfPage=None,showPlots=False,title=None,mam
         b,r = bv_rhk[i][0][j], bv_rhk[i][1][j]
         mamajek_ages.append(utils.getMamaAge(r))
         post = baf.get_posterior(b,r)
-        post_prod += np.log(post.array)
+        post_prod += post.log_array
         stat = post.stats
         my_ages.append(stat[2])
         my_error.append((stat[2] - stat[1],stat[3] - stat[2]))
 
-    post_prod = prob.normalize(const.AGE,np.exp(post_prod))
-    baffles_age = prob.stats(const.AGE,post_prod)[2]
+    post_prod = prob.log_normalize(const.AGE,post_prod)
+    baffles_age = prob.stats(const.AGE,post_prod,log=True)[2]
 
     plt.Line2D([0], [0], color='C%d'% i,marker=const.MARKERS[i],label=const.CLUSTER_NAMES[i])
     plt.axis([.4,14000,.4,14000])
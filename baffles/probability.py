@@ -1,12 +1,20 @@
 import numpy as np
 from scipy import integrate
+from scipy.special import logsumexp
 import bisect
+from functools import lru_cache
 from scipy.stats import norm
+from numpy.polynomial.hermite_e import hermegauss
 import matplotlib.pyplot as plt
 
 FIVE_SIGMAS = 9.02e-07
 GAUSS_PROBS = [.0227501,.158655,.5,.841345, .97725] #[-2 sig,-1,mu,+1,+2]
 UL_PROBS = [0.0026998,0.04550026,0.31731051,1] #[1-.99,1-.95,1-.68, maxAge]
+QUADRATURES = ['equal_area','hermite'] #rules of standard_normal_quadrature
+HERMITE_MAX_POINTS = 100 #hermegauss weights turn to nan from about 400 points
+HDI_TOLERANCE = 1e-5 #error in probability allowed in the mass of a highest density interval
+HDI_MAX_STEPS = 40
+RESAMPLE_BLOCK = 2**22 #elements of the counts matrix of resample_log_sums done at once
 
 #squared residuals divided by std**2 if given
 def chi_sqr(x,mu,sig=1,total=False):
@@ -61,6 +69,31 @@ def gaussian_cdf_space(mu,sig,num,sig_lim=5):
     #plt.show()
     return arr
 
+# Nodes z and weights of a num point rule for integrating against a standard normal, so
+# sum(w*f(mu + sig*z)) approximates num times the mean of f over a gaussian(mu,sig).
+# 'equal_area' puts a point in the middle of num equal area sections, like
+# gaussian_cdf_space but exact, with weights of 1. 'hermite' is Gauss-Hermite quadrature,
+# which only pays off for smooth f and is limited to HERMITE_MAX_POINTS, well below the
+# count where hermegauss returns nan weights. Rules are cached by (num,method) and returned
+# read-only
+@lru_cache(maxsize=None)
+def standard_normal_quadrature(num,method='equal_area'):
+    if method == 'equal_area':
+        z = norm.ppf((np.arange(num) + 0.5)/num)
+        w = np.ones(num)
+    elif method == 'hermite':
+        if num > HERMITE_MAX_POINTS:
+            raise RuntimeError("Gauss-Hermite rules have at most %d points, not %d" % \
+                               (HERMITE_MAX_POINTS,num))
+        z,w = hermegauss(num)
+        w *= num/np.sum(w)
+    else:
+        raise RuntimeError("Unknown quadrature '%s'. Please enter one of %s" % \
+                           (method,QUADRATURES))
+    z.setflags(write=False)
+    w.setflags(write=False)
+    return z,w
+
 # takes in densely sampled x,y and returns num sampled x
 def desample(x,y,num):
     import baffles.fitting as my_fits
@@ -72,14 +105,30 @@ def desample(x,y,num):
     new_y = my_fits.piecewise(x,y)(new_x)
     return new_x,new_y
 
-#normalizes in-place
+#normalizes in-place. y can be 2D with one function per row
 def normalize(x,y):
-    area = np.trapz(y,x)
-    assert area > 0, "Invalid function to Normalize. Integral=%f" % area
-    if area == 1: return y
-    y[:] = y / area
+    area = np.trapz(y,x,axis=-1)
+    assert np.all(area > 0), "Invalid function to Normalize. Integral=" + str(area)
+    if np.all(area == 1): return y
+    y[:] = y / np.expand_dims(area,-1)
     return y
 
+#log of the trapezoid rule weights on x, so that trapz(y,x) = sum(exp(log_y + weights))
+def log_trapz_weights(x):
+    w = np.zeros(len(x))
+    w[:-1] += np.diff(x)/2
+    w[1:] += np.diff(x)/2
+    return np.log(w)
+
+#normalize for the log of a function, in-place. ln_y can be 2D with one function per row.
+# The area comes from logsumexp so rows far below the float range still normalize
+def log_normalize(x,ln_y):
+    log_area = logsumexp(ln_y + log_trapz_weights(x),axis=-1,keepdims=True)
+    assert np.all(np.isfinite(log_area)), "Invalid function to Normalize. log(Integral)=" \
+            + str(log_area)
+    ln_y -= log_area.astype(ln_y.dtype)
+    return ln_y
+
 #scales y so that max(y) = height
 def scale_to_height(y,height):
     scale = height/np.max(y)
@@ -96,36 +145,204 @@ def hist_cdf(vals):
     cdf /= cdf[-1]
     return x,cdf
 
+#log of the cdf of each row of a matrix lnY of log functions of x. The trapezoid areas
+# between ages are summed with logaddexp, so no row has to be exponentiated as a whole
+def log_cdf_batch(x,lnY):
+    lnY = np.atleast_2d(lnY).astype(float)
+    areas = np.logaddexp(lnY[:,1:],lnY[:,:-1]) + np.log(np.diff(x)/2)
+    c = np.empty(lnY.shape)
+    c[:,0] = -np.inf
+    np.logaddexp.accumulate(areas,axis=1,out=c[:,1:])
+    c -= c[:,-1:]
+    return c
+
 #finds the x value with the largest y value
 def mode(x,y):
     return x[np.argmax(y)]
 
 #finds median age,ranges for 1,2 sigma as [-2 sigma,-1 sigma, median,+1 sigma,+2 sigma]
-#finds ages from cdf values
-def stats(age,y,upperLim=False):
+#finds ages from cdf values. With log=True y is the log of the posterior
+def stats(age,y,upperLim=False,log=False):
     import baffles.fitting as my_fits
-    c = cdf(age,y)
+    c = np.exp(log_cdf_batch(age,y)[0]) if log else cdf(age,y)
     probs = UL_PROBS if upperLim else GAUSS_PROBS
     fit = my_fits.piecewise(c,age)
     return fit(probs)
 
+#cdf of each row of a matrix Y of functions of x, by cumulative trapezoid sums along the rows
+def cdf_batch(x,Y):
+    c = integrate.cumtrapz(np.atleast_2d(Y),x,axis=1,initial=0)
+    c /= c[:,-1:]
+    return c
+
+#searchsorted (side='left') of each row of v in the same row of A, whose rows are sorted.
+# A binary search over the columns done for all rows and values at once
+def searchsorted_rows(A,v):
+    rows = np.arange(len(A)).reshape(-1,1)
+    lo = np.zeros(v.shape,dtype=int)
+    hi = np.full(v.shape,A.shape[1])
+    while np.any(lo < hi):
+        active = lo < hi
+        mid = (lo + hi)//2
+        below = A[rows,np.minimum(mid,A.shape[1] - 1)] < v
+        lo,hi = np.where(active & below,mid + 1,lo),np.where(active & ~below,mid,hi)
+    return lo
+
+#same as stats for a matrix Y with one posterior per row, returning a row of stats per
+# posterior. probs is any list of cdf values, by default UL_PROBS or GAUSS_PROBS, and
+# upperLim can be given per row. The cdf ages of all rows are found in one search and by
+# linear interpolation like the interp1d of stats. With log=True Y holds log posteriors
+def stats_batch(age,Y,probs=None,upperLim=False,log=False):
+    c = np.exp(log_cdf_batch(age,Y)) if log else cdf_batch(age,Y)
+    upperLim = np.broadcast_to(upperLim,len(c))
+    width = len(probs) if probs is not None else \
+            max(len(UL_PROBS) if ul else len(GAUSS_PROBS) for ul in set(upperLim))
+    result = np.full((len(c),width),np.nan)
+    for ul in [False,True]:
+        rows = np.nonzero(upperLim == ul)[0]
+        if len(rows) == 0: continue
+        p = np.asarray(probs if probs is not None else (UL_PROBS if ul else GAUSS_PROBS),
+                       dtype=float)
+        #first age where the cdf reaches each prob
+        hi = np.clip(searchsorted_rows(c[rows],np.tile(p,(len(rows),1))),1,len(age) - 1)
+        c_lo,c_hi = np.take_along_axis(c[rows],hi - 1,1),np.take_along_axis(c[rows],hi,1)
+        result[rows,:len(p)] = age[hi - 1] + (p - c_lo)*(age[hi] - age[hi - 1])/(c_hi - c_lo)
+    return result
+
+#highest density intervals for each row of a matrix Y on x, one for each probability in
+# masses: the interval between the first and last ages where the density is above the
+# level at which the interval holds the mass. The ages of each row are sorted by density
+# once, and summing their trapezoid weights on the non-uniform x in that order gives a
+# first level for every mass. The mass of an interval, for a density linear between
+# ages, only grows as the level drops, so the level is then found by false position
+# (Illinois) within a bracket, for the (row,mass) pairs not yet within HDI_TOLERANCE of
+# the mass. Where the mass
+# jumps past the target (the level reaching a second peak or a flat top) the interval
+# is the one holding more than it. Returns [lower,upper] with shape (rows,2), or
+# (rows,len(masses),2) if masses is a list. With log=True Y holds log posteriors
+def hdi_batch(x,Y,masses=0.68,log=False):
+    Y = np.atleast_2d(Y)
+    num = len(np.atleast_1d(masses))
+    density = np.exp(Y - np.max(Y,axis=1,keepdims=True)) if log else np.asarray(Y,dtype=float)
+    order = np.argsort(-density,axis=1,kind='stable')
+    ranked = np.take_along_axis(density,order,1)
+    cum = np.cumsum(np.take_along_axis(density*np.exp(log_trapz_weights(x)),order,1),axis=1)
+    cum /= cum[:,-1:]
+    #level between the densities of the ages before and after the node masses reach mass
+    m = np.tile(np.atleast_1d(np.asarray(masses,dtype=float)),(len(Y),1))
+    k = np.clip(searchsorted_rows(cum,m),1,len(x) - 1)
+    c_lo,c_hi = np.take_along_axis(cum,k - 1,1),np.take_along_axis(cum,k,1)
+    d_lo,d_hi = np.take_along_axis(ranked,k - 1,1),np.take_along_axis(ranked,k,1)
+    level = (d_lo + np.clip((m - c_lo)/np.where(c_hi > c_lo,c_hi - c_lo,1),0,1)*(d_hi - d_lo))
+
+    c = integrate.cumtrapz(density,x,axis=1,initial=0)
+    area = c[:,-1:].copy()
+    c /= area
+    #ends of the interval of each level for rows r and the mass between them. Each end is
+    # found from the age inside it next to it, and the area between the two is taken
+    # off the cdf there
+    def interval(level,r):
+        d = density[r]
+        above = d >= level.reshape(-1,1)
+        first = np.argmax(above,axis=1)
+        last = len(x) - 1 - np.argmax(above[:,::-1],axis=1)
+        ends,mass = [],0
+        for inside,outside,sign in [(first,np.maximum(first - 1,0),-1),
+                                    (last,np.minimum(last + 1,len(x) - 1),1)]:
+            d_in,d_out = density[r,inside],density[r,outside]
+            f = np.clip((d_in - level)/np.where(d_in > d_out,d_in - d_out,np.inf),0,1)
+            end = x[inside] + f*(x[outside] - x[inside])
+            ends.append(end)
+            mass = mass + sign*(c[r,inside] + (end - x[inside])*(2*d_in + f*(d_out - d_in))/
+                                2/area[r,0])
+        return np.column_stack(ends),mass
+
+    #one problem per (row,mass), bracketed by levels with at least and at most the mass
+    r = np.repeat(np.arange(len(Y)),num)
+    m,level = m.ravel(),level.ravel()
+    lo,F_lo = np.zeros(len(m)),1 - m #F is the mass minus the target at the bracket ends
+    hi,F_hi = np.ones(len(m)),-m
+    moved = np.zeros(len(m)) #end of the bracket moved last, 1 for lo and -1 for hi
+    result = np.tile([x[0],x[-1]],(len(m),1))
+    active = np.arange(len(m))
+    for _ in range(HDI_MAX_STEPS):
+        ends,mass = interval(level[active],r[active])
+        F = mass - m[active]
+        done = np.abs(F) <= HDI_TOLERANCE
+        more = F >= 0
+        result[active[more | done]] = ends[more | done]
+        side = np.where(more,1,-1)
+        #the end kept twice in a row has its F halved so both ends move
+        F_hi[active[more & (moved[active] == 1)]] /= 2
+        F_lo[active[~more & (moved[active] == -1)]] /= 2
+        moved[active] = side
+        lo[active[more]],F_lo[active[more]] = level[active[more]],F[more]
+        hi[active[~more]],F_hi[active[~more]] = level[active[~more]],F[~more]
+        active = active[~done & (hi[active] - lo[active] > 1e-12)]
+        if len(active) == 0: break
+        a,b = lo[active],hi[active]
+        level[active] = a + F_lo[active]/(F_lo[active] - F_hi[active])*(b - a)
+    result = result.reshape(len(Y),num,2)
+    return result if np.ndim(masses) else result[:,0]
+
+#equal-tailed credible intervals for each row of Y on x, one for each probability in levels:
+# the ages at cdf values (1 - level)/2 and (1 + level)/2, found together by stats_batch.
+# Returns the same shapes as hdi_batch
+def credible_batch(x,Y,levels=0.68,log=False):
+    l = np.atleast_1d(np.asarray(levels,dtype=float))
+    q = stats_batch(x,Y,np.concatenate([(1 - l)/2,(1 + l)/2]),log=log)
+    result = np.stack([q[:,:len(l)],q[:,len(l):]],axis=-1)
+    return result if np.ndim(levels) else result[:,0]
+
 # takes in a PDF given by age,y and a given age to compare to
 # returns the percentile X such that given Age is within X %
+# y can also be a matrix with one PDF per row, and givenAge one age or one per row
 def get_percentile(age,y,givenAge):
-    import baffles.fitting as my_fits
-    c = cdf(age,y)
-    fit = my_fits.piecewise(age,c)
-    return np.abs(fit(givenAge) - .5)*2*100
-
-#calls func many times changing resample_args, keeping args constant
-# returns product of calls
-def resample(func,resample_args,args, sample_num=10,numIter=4):
-    indices = np.arange(len(resample_args[0]))
+    c = cdf_batch(age,y)
+    givenAge = np.broadcast_to(np.asarray(givenAge,dtype=float),len(c))
+    #the cdf is linear between ages and extrapolated past the ends, like piecewise
+    i = np.clip(np.searchsorted(age,givenAge) - 1,0,len(age) - 2)
+    rows = np.arange(len(c))
+    cum = c[rows,i] + (givenAge - age[i])*(c[rows,i+1] - c[rows,i])/(age[i+1] - age[i])
+    percentile = np.abs(cum - .5)*2*100
+    return percentile[0] if np.ndim(y) == 1 else percentile
+
+#indices of numIter draws of sample_num of num stars, one row per draw, without replacement
+# unless replace. seed is anything np.random.default_rng takes, a seed or a Generator
+def resample_indices(num,sample_num,numIter,replace=False,seed=None):
+    rng = np.random.default_rng(seed)
+    if replace:
+        return rng.integers(0,num,size=(numIter,sample_num))
+    return np.argsort(rng.random((numIter,num)),axis=1)[:,:sample_num]
+
+#sums of the rows of log_post (N x len(age) log posteriors) picked by each row of indices,
+# done as matrix products of the number of times each star is picked in a draw with the
+# rows, RESAMPLE_BLOCK elements of counts at a time. -inf entries are left out of the
+# product and give -inf wherever a picked star has one. Returns len(indices) x len(age)
+def resample_log_sums(log_post,indices):
+    indices = np.atleast_2d(indices)
+    finite = np.isfinite(log_post)
+    log_post = np.where(finite,log_post,0)
+    ruled_out = (~finite).astype(log_post.dtype)
+    sums = np.empty((len(indices),log_post.shape[1]))
+    block = max(1,RESAMPLE_BLOCK//len(log_post))
+    for k in range(0,len(indices),block):
+        ind = indices[k:k+block]
+        counts = np.zeros((len(ind),len(log_post)),dtype=log_post.dtype)
+        np.add.at(counts,(np.arange(len(ind)).reshape(-1,1),ind),1)
+        sums[k:k+block] = counts @ log_post
+        sums[k:k+block][(counts @ ruled_out) > 0] = -np.inf
+    return sums
+
+#calls func many times changing resample_args, keeping args constant. func returns a
+# posterior, whose log_array are summed. Returns the log of the product of calls
+# When the calls are posterior products, age_estimator.resample_posterior_product gets the
+# same from the star posteriors computed once
+def resample(func,resample_args,args, sample_num=10,numIter=4,seed=None):
     log_sum = 0
-    for _ in range(numIter):
-        inds = np.random.choice(indices,size=sample_num,replace=False)
+    for inds in resample_indices(len(resample_args[0]),sample_num,numIter,seed=seed):
         sampled_args = tuple(np.take(arr,inds) for arr in resample_args)
         argv = sampled_args + args
-        log_sum += np.log(func(*argv))
+        log_sum = log_sum + func(*argv).log_array
 
-    return np.exp(log_sum)
+    return log_sum
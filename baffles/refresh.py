@@ -22,6 +22,10 @@ def main():
                 linSpace=False,scale_by_std= False,vs_age_fit=True,zero_center=True)
     my_fits.fit_histogram('calcium',residual_arr=res_arr,fromFile=False,saveToFile=True)
 
+    #rebuilds the posterior table if the median grid or likelihood fit changed
+    baf = baffles.age_estimator('calcium',grid_median=join('grids','median_rhk_'+date))
+    if baf.posterior_table is None:
+        baf.make_posterior_table()
 
 
     const = utils.init_constants('lithium')
@@ -35,6 +39,10 @@ def main():
                                         vs_age_fit=True,zero_center=True)
     my_fits.fit_histogram('lithium',residual_arr=res_arr,fromFile=False,saveToFile=True)
 
+    baf2 = baffles.age_estimator('lithium',grid_median=join('grids','median_li_'+date))
+    if baf2.stats_table is None:
+        baf2.make_stats_table()
+
 
 
 if  __name__ == "__main__":
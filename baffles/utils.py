@@ -5,6 +5,7 @@ from scipy.stats import norm
 from scipy.stats.mstats import gmean
 import sys
 import datetime
+import hashlib
 
 #returns true if sig or any element of sig is <= MIN_SIG
 def negative_sig(sig):
@@ -46,6 +47,20 @@ def init_constants(metal):
         raise RuntimeError("No metal specified. Please enter lithium or calcium")
     return const
 
+#md5 of the contents of a file, used to tell when saved grids have changed
+def file_hash(filename):
+    with open(filename,'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+#md5 of the contents of arrays, used to tell when grids in memory have changed
+def array_hash(*arrays):
+    h = hashlib.md5()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(str((a.dtype.str,a.shape)).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
 def progress_bar(frac,secondsLeft=None):
     sys.stdout.write('\r')
     sys.stdout.write("[%-25s] %d%% ETA: " % ('='*int(frac*100/4 - 1) + '>', frac*100) + \
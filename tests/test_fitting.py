@@ -0,0 +1,21 @@
+"""
+Checks piecewise_linear against the interp1d it replaces
+"""
+import numpy as np
+import pytest
+from scipy.interpolate import interp1d
+import baffles.fitting as my_fits
+
+X_NEW = np.array([np.nan,-np.inf,np.inf,-5,0,0.5,1,2,2.5,3,3.25,10])
+
+@pytest.mark.parametrize('x,y',[
+    (np.linspace(0,3,7),np.sin(np.linspace(0,3,7))), #uniform, found by index arithmetic
+    ([0,0.2,1,2,2.5,3],[1,3,2,0,-1,4]),               #searchsorted
+    ([0,1,1,2,3],[0,1,5,2,3]),                        #repeated x
+    ([2,0,3,1,0.5],[4,1,0,2,3]),                      #unsorted x
+    ([0,1,2,3],[1,1,1,1]),                            #zero slopes, inf*0 is nan
+])
+def test_piecewise_matches_interp1d(x,y):
+    expected = interp1d(x,y,fill_value='extrapolate')(X_NEW)
+    np.testing.assert_allclose(my_fits.piecewise(x,y)(X_NEW),expected,rtol=1e-12,atol=1e-12)
+    assert np.ndim(my_fits.piecewise(x,y)(1.5)) == 0
@@ -0,0 +1,41 @@
+"""
+Checks the products that reuse star posteriors against products computed from scratch
+"""
+import numpy as np
+import pytest
+import baffles.baffles as baffles
+
+#calcium stars where the posterior table rules out ages for some but not all of them
+CA_STARS = ([0.65]*5,[-3.75,-3.8,-3.72,-4.0,-3.9])
+LI_STARS = ([0.55,0.62,0.7,0.78,0.85],[120,90,70,40,25])
+
+#lithium posteriors depend slightly on the stars sharing a Li EW grid (li_tolerance)
+@pytest.mark.parametrize('metal,stars,rtol',[('calcium',CA_STARS,1e-9),
+                                             ('lithium',LI_STARS,1e-3)])
+def test_jackknife_matches_products(metal,stars,rtol):
+    est = baffles.age_estimator(metal)
+    bv,metallicity = stars
+    batch,influence = est.jackknife_posterior_product(bv,metallicity)
+    assert np.all(np.isfinite(influence))
+    for i in range(len(bv)):
+        keep = [j for j in range(len(bv)) if j != i]
+        product = est.posterior_product([bv[j] for j in keep],[metallicity[j] for j in keep])
+        np.testing.assert_allclose(batch.stats[i],product.stats,rtol=rtol)
+
+#removing a star that rules out ages from the table must bring them back
+def test_cluster_add_remove_matches_product():
+    est = baffles.age_estimator('calcium')
+    bv,rhk = CA_STARS
+    cluster = baffles.cluster_posterior(est)
+    keys = cluster.add_stars(bv,rhk)
+    np.testing.assert_allclose(cluster.stats,est.posterior_product(bv,rhk).stats,rtol=1e-9)
+    removed = []
+    for i in [2,0]:
+        cluster.remove_star(keys[i])
+        removed.append(i)
+        keep = [j for j in range(len(bv)) if j not in removed]
+        product = est.posterior_product([bv[j] for j in keep],[rhk[j] for j in keep])
+        np.testing.assert_allclose(cluster.stats,product.stats,rtol=1e-9)
+    cluster.add_star(bv[2],rhk[2])
+    product = est.posterior_product(bv[1:],rhk[1:])
+    np.testing.assert_allclose(cluster.stats,product.stats,rtol=1e-9)
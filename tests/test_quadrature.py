@@ -0,0 +1,23 @@
+"""
+Checks the B-V quadrature rules and the point counts the estimator picks for them
+"""
+import numpy as np
+import pytest
+import baffles.baffles as baffles
+import baffles.probability as prob
+
+def test_hermite_is_capped():
+    with pytest.raises(RuntimeError):
+        prob.standard_normal_quadrature(prob.HERMITE_MAX_POINTS + 1,'hermite')
+    est = baffles.age_estimator('lithium',quadrature='hermite')
+    assert est.bv_point_count(0.8) == prob.HERMITE_MAX_POINTS
+    assert np.all(np.isfinite(est.get_posteriors([0.65],[100],[0.8])))
+
+#the tolerance is on the change between doublings, so the error can be a few times larger
+def test_bv_tolerance_converges():
+    bv,li,bv_err = [0.6,0.9,1.3],[150,60,20],[0.01,0.02,0.03]
+    ref = baffles.age_estimator('lithium',num_bv_points=1500)
+    exact = ref.get_posteriors(bv,li,bv_err)
+    est = baffles.age_estimator('lithium',bv_tolerance=1e-3)
+    approx = est.get_posteriors(bv,li,bv_err)
+    assert np.max(np.trapz(np.abs(approx - exact),est.age,axis=1)) < 1e-2